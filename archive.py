@@ -0,0 +1,169 @@
+import os
+import re
+import errno
+import tarfile
+
+import metrics
+from transfer import READ_CHUNK, CHECKSUMS, ChecksumError, checksumMatches, unthrottled
+
+"""
+Archive packaging for PollCAT plugins
+
+A download of many small files is slow to copy file by file, uses up
+inodes in the user's home directory and is slow for Globus to move on.
+An ArchiveWriter instead streams the files straight from the archive
+into one or more tar files, optionally gzipped at the fastest level, in
+a single sequential pass. A new part is started each time the current
+one holds splitSize bytes of tar, before compression.
+
+Each part is written under a .partial name and renamed once complete,
+so a user never sees a truncated archive. A retry of the same request
+writes the archive again from the start, replacing the parts left by
+the earlier attempt; otherwise an existing archive is never overwritten.
+The files can be throttled by a throttle.Governor and checked against
+their ICAT checksums as they are read, as with transfer.Copier.
+"""
+
+class Reader(object):
+    """
+    Reads a file in READ_CHUNK blocks for tarfile, which asks for 16KB at
+    a time, throttling and checksumming each block
+    """
+
+    def __init__(self, f, throttle, digest):
+        self.f = f
+        self.throttle = throttle
+        self.digest = digest
+        self.block = ''
+        self.offset = 0
+
+
+    def read(self, size):
+        if self.offset >= len(self.block):
+            self.block = self.f.read(max(size, READ_CHUNK))
+            self.offset = 0
+            self.throttle(len(self.block))
+            if self.digest is not None:
+                self.digest.update(self.block)
+        data = self.block[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+class ArchiveWriter(object):
+    """
+    Writes the files of one download into tar files
+    """
+
+    def __init__(self, directory, name, compress, splitSize, logger, algorithm=None, governor=None, replace=False):
+        """
+        Parameters:
+            directory - where to write the archive parts
+            name - the archive name, without an extension
+            compress - True to gzip the parts
+            splitSize - the bytes of tar after which to start a new part,
+                        or 0 to write a single part
+            algorithm - a name from transfer.CHECKSUMS to verify each file
+                        with, or None
+            governor - the throttle.Governor limiting reads, if any
+            replace - True to remove the parts of an earlier attempt at
+                      the same archive first
+        """
+        self.directory = directory
+        self.name = name
+        self.compress = compress
+        self.splitSize = splitSize
+        self.logger = logger
+        self.algorithm = algorithm
+        self.governor = governor
+        self.parts = []     #completed parts
+        self.tar = None
+        self.path = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        elif replace:
+            # parts left by an earlier attempt, which may have had more
+            pattern = re.escape(name) + r'(-\d{3})?\.tar(\.gz)?(\.partial)?$'
+            for entry in os.listdir(directory):
+                if re.match(pattern, entry):
+                    os.unlink(os.path.join(directory, entry))
+
+
+    def partPath(self, number):
+        extension = '.tar.gz' if self.compress else '.tar'
+        if self.splitSize:
+            return os.path.join(self.directory, '%s-%03i%s' % (self.name, number, extension))
+        return os.path.join(self.directory, self.name + extension)
+
+
+    def start(self):
+        self.path = self.partPath(len(self.parts) + 1)
+        if os.path.exists(self.path):
+            raise IOError(errno.EEXIST, "Archive already exists", self.path)
+        self.logger.debug("Writing archive %s" % self.path)
+        if self.compress:
+            self.tar = tarfile.open(self.path + '.partial', 'w:gz', compresslevel=1)
+        else:
+            self.tar = tarfile.open(self.path + '.partial', 'w')
+
+
+    def finish(self):
+        self.tar.close()
+        os.rename(self.path + '.partial', self.path)
+        self.parts.append(self.path)
+        self.tar = None
+
+
+    def add(self, source, arcname, checksum=None):
+        """
+        Append source to the archive as arcname, returning its size
+        """
+        if self.tar is None:
+            self.start()
+
+        info = self.tar.gettarinfo(source, arcname)
+        throttle = unthrottled
+        if self.governor is not None:
+            device = os.stat(source).st_dev
+            throttle = lambda size, ops=1: self.governor.take(device, size, ops)
+        digest = None
+        if self.algorithm is not None and checksum:
+            digest = CHECKSUMS[self.algorithm]()
+
+        # opening the file
+        throttle(0)
+        with open(source, 'rb') as f:
+            self.tar.addfile(info, Reader(f, throttle, digest) if info.isreg() else None)
+
+        if digest is not None and not checksumMatches(checksum, digest.hexdigest()):
+            # the file is already in the tar, so the archive has to be written again
+            metrics.CHECKSUM_MISMATCHES.inc()
+            raise ChecksumError("%s checksum of %s is %s, not %s as ICAT records" % (
+                self.algorithm, source, digest.hexdigest(), checksum))
+
+        if self.splitSize and self.tar.offset >= self.splitSize:
+            self.finish()
+        return info.size
+
+
+    def close(self):
+        """
+        Finish the last part and return the paths of all the parts
+        """
+        if self.tar is not None:
+            self.finish()
+        return self.parts
+
+
+    def abort(self):
+        """
+        Remove the part being written after a failure
+        """
+        if self.tar is not None:
+            try:
+                self.tar.close()
+            except Exception:
+                pass
+            os.unlink(self.path + '.partial')
+            self.tar = None
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import zlib
+import random
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+"""
+Local stand-ins for TopCAT, the IDS and ICAT used by the benchmarks
+
+FakeServices serves, on one local port:
+
+    GET /topcat/admin/downloads                 - the RESTORING requests
+    PUT /topcat/admin/download/<id>/status      - mark a request COMPLETE
+    GET /ids/getDatafileIds?preparedId=         - a request's datafile ids
+    GET /ids/getStatus?datafileIds=             - ONLINE once restored
+
+Each request's files become ONLINE restoreTime seconds after the start,
+and every call waits latency seconds before answering. FakeIcat answers
+the Datafile searches the plugins make from the same set of files, which
+are written under a source directory so the plugins can copy them.
+"""
+
+class Datafile(object):
+    """
+    Looks enough like a python-icat Datafile for the plugins
+    """
+
+    def __init__(self, id, location, fileSize, checksum):
+        self.id = id
+        self.location = location
+        self.fileSize = fileSize
+        self.checksum = checksum
+
+
+class FakeRequest(object):
+
+    def __init__(self, id, datafiles, readyAt):
+        self.id = id
+        self.preparedId = 'bench-%06i' % id
+        self.datafiles = datafiles
+        self.readyAt = readyAt
+        self.completedAt = None
+
+
+    def json(self):
+        return {
+            'id'         : self.id,
+            'preparedId' : self.preparedId,
+            'userName'   : 'bench',
+            'fileName'   : 'download_%i' % self.id,
+            'transport'  : 'globus',
+            'status'     : 'COMPLETE' if self.completedAt else 'RESTORING'
+        }
+
+
+class FakeServices(object):
+    """
+    The fake TopCAT and IDS, plus the files behind their requests
+    """
+
+    def __init__(self, source, requests, files, size, latency, restoreTime):
+        """
+        Parameters:
+            source - directory to write the request files under
+            requests - the number of download requests
+            files - the number of files in each request
+            size - the size in bytes of each file
+            latency - seconds to wait before answering each call
+            restoreTime - the most seconds a request spends RESTORING
+        """
+        self.latency = latency
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.datafiles = {}     #datafile id:(Datafile, FakeRequest)
+        self.calls = {}         #path:count
+
+        content = os.urandom(size)
+        checksum = '%08x' % (zlib.crc32(content) & 0xffffffff)
+        datafileId = 0
+        for i in range(1, requests + 1):
+            request = FakeRequest(i, [], self.start + random.uniform(0, restoreTime))
+            for j in range(files):
+                datafileId += 1
+                location = 'request%i/dir%i/file%i.dat' % (i, j % 10, datafileId)
+                path = os.path.join(source, location)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(content)
+                datafile = Datafile(datafileId, location, size, checksum)
+                request.datafiles.append(datafile)
+                self.datafiles[datafileId] = (datafile, request)
+            self.requests.append(request)
+
+
+    def count(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+
+    def handle(self, method, path, params):
+        """
+        Return (status, body) for a call
+        """
+        time.sleep(self.latency)
+        self.count(re.sub('/\d+', '/{id}', path))
+
+        if method == 'GET' and path == '/topcat/admin/downloads':
+            # honours the "download.id > N ... LIMIT offset, count" paging pollcat uses
+            requests = [r for r in self.requests if r.completedAt is None]
+            match = re.search('download\.id > (\d+)', params.get('queryOffset', ''))
+            if match:
+                requests = [r for r in requests if r.id > int(match.group(1))]
+            match = re.search('LIMIT (\d+), (\d+)', params.get('queryOffset', ''))
+            if match:
+                requests = requests[int(match.group(1)):int(match.group(1)) + int(match.group(2))]
+            return 200, json.dumps([r.json() for r in requests])
+
+        if method == 'GET' and path == '/ids/getDatafileIds':
+            for request in self.requests:
+                if request.preparedId == params['preparedId']:
+                    return 200, json.dumps({'ids' : [df.id for df in request.datafiles]})
+            return 404, ''
+
+        if method == 'GET' and path == '/ids/getStatus':
+            now = time.time()
+            for datafileId in params['datafileIds'].split(','):
+                if self.datafiles[int(datafileId)][1].readyAt > now:
+                    return 200, 'RESTORING'
+            return 200, 'ONLINE'
+
+        match = re.match('^/topcat/admin/download/(\d+)/status$', path)
+        if method == 'PUT' and match and params.get('value') == 'COMPLETE':
+            request = self.requests[int(match.group(1)) - 1]
+            if request.completedAt is None:
+                request.completedAt = time.time()
+            return 200, ''
+
+        return 404, ''
+
+
+    def serve(self):
+        """
+        Start answering calls on a free local port, returning its url
+        """
+        services = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # send each response in one segment, or keep-alive clients sit
+            # out a delayed ACK on every call
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                url = urlparse.urlparse(self.path)
+                params = dict(urlparse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    params.update(urlparse.parse_qsl(self.rfile.read(length)))
+                status, body = services.handle(method, url.path, params)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+
+    def done(self):
+        return all(r.completedAt is not None for r in self.requests)
+
+
+class FakeIcat(object):
+    """
+    Stands in for a logged in icat.client.Client, answering the Datafile
+    searches made by the plugins, including the SUM(df.fileSize) of globus
+    capacity checks
+    """
+
+    def __init__(self, services, latency):
+        self.services = services
+        self.latency = latency
+        self.sessionId = 'bench-session'
+
+
+    def refresh(self):
+        time.sleep(self.latency)
+
+
+    def search(self, query):
+        time.sleep(self.latency)
+        match = re.search('df\.id\s*(?:IN\s*\(([\d,\s]+)\)|=\s*(\d+))', query)
+        if match is None:
+            return []
+        ids = (match.group(1) or match.group(2)).split(',')
+        datafiles = [self.services.datafiles[int(i)][0] for i in ids if int(i) in self.services.datafiles]
+        if re.match('SELECT SUM\(df\.fileSize\)', query):
+            return [sum(df.fileSize for df in datafiles)]
+        return datafiles
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import ConfigParser
+
+"""
+PollCAT benchmark
+
+Runs the real pollcat main loop, and optionally the globus plugin, against
+the local stand-ins in bench/fakes.py and reports:
+
+    cycle latency    - how long each main loop pass takes
+    time-to-delivery - from a request's files coming ONLINE to TopCAT
+                       being told it is COMPLETE
+    copy throughput  - files and bytes per second written by the plugin
+    calls            - how many calls of each kind the services answered
+
+Run from anywhere, e.g.
+
+    python bench/run.py --requests 50 --files 200 --size 65536 --plugin globus
+    python bench/run.py --plugin globus --set ENGINE=gevent
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# as in pollcat.py, the gevent engine patches the standard library before
+# anything else imports it
+if 'ENGINE=gevent' in sys.argv:
+    import engines
+    engines.patch()
+
+import common
+import metrics
+import pollcat
+import plugins
+from bench.fakes import FakeServices, FakeIcat
+
+
+class NullPlugin(object):
+    """
+    Delivers instantly, to measure the core loop on its own
+    """
+
+    def __init__(self, request, datafileIds, config, logger):
+        pass
+
+
+    def run(self):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def summary(name, values, unit='s'):
+    if not values:
+        return "%-18s no samples" % name
+    return "%-18s mean %.3f%s  p50 %.3f%s  p95 %.3f%s  max %.3f%s  (n=%i)" % (
+        name, sum(values) / len(values), unit, percentile(values, 0.5), unit,
+        percentile(values, 0.95), unit, max(values), unit, len(values)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pollcat against fake TopCAT/IDS/ICAT services")
+    parser.add_argument('--requests', type=int, default=20, help="download requests to deliver")
+    parser.add_argument('--files', type=int, default=100, help="files per request")
+    parser.add_argument('--size', type=int, default=4096, help="bytes per file")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds added to every TopCAT/IDS call")
+    parser.add_argument('--icat-latency', type=float, default=0.005, help="seconds added to every ICAT call")
+    parser.add_argument('--restore-time', type=float, default=5, help="most seconds a request spends RESTORING")
+    parser.add_argument('--plugin', choices=('none', 'globus'), default='none', help="plugin to deliver with")
+    parser.add_argument('--config', default='pollcat.config', help="pollcat config to start from")
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help="override a [main] option, e.g. --set WORKERS=8")
+    parser.add_argument('--timeout', type=float, default=600, help="give up after this many seconds")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pollcat-bench-')
+    try:
+        source = os.path.join(workdir, 'source')
+        destination = os.path.join(workdir, 'destination')
+        os.makedirs(destination)
+
+        print "Creating %i requests of %i files..." % (args.requests, args.files)
+        services = FakeServices(source, args.requests, args.files, args.size, args.latency, args.restore_time)
+        url = services.serve()
+        icat = FakeIcat(services, args.icat_latency)
+        common.IcatClient.getInstance = lambda self: icat
+
+        config = ConfigParser.ConfigParser()
+        config.read(args.config)
+        for option, value in [('ICAT_URL', url), ('TOPCAT_URL', url), ('IDS_URL', url),
+                              ('PLUGIN_NAME', 'globus'), ('DELAY', '1'), ('ENGINE', 'threads'),
+                              ('JOURNAL', os.path.join(workdir, 'journal.db')),
+                              ('DATAFILEIDS_CACHE_DIR', ''), ('METRICS_PORT', '0'), ('METRICS_FILE', '')]:
+            config.set('main', option, value)
+        for override in args.set:
+            option, value = override.split('=', 1)
+            config.set('main', option, value)
+
+        logging.basicConfig(level=logging.WARN, format='%(levelname)s - %(message)s')
+        pollcat.setup(config, logging.getLogger('bench'))
+
+        if args.plugin == 'none':
+            pollcat.plugin = plugins.wrapPlugin(NullPlugin, config, pollcat.logger)
+        else:
+            from plugins.globus import globus
+
+            class BenchGlobus(globus.Plugin):
+                def setup(self):
+                    super(BenchGlobus, self).setup()
+                    self.config.set('globus', 'SOURCE', source)
+                    self.config.set('globus', 'DESTINATION', destination)
+
+                def createuser(self, username):
+                    pass
+
+                def run(self):
+                    copying.append(time.time())
+                    super(BenchGlobus, self).run()
+                    copying.append(time.time())
+
+            pollcat.plugin = plugins.wrapPlugin(BenchGlobus, config, pollcat.logger)
+
+        print "Running..."
+        copying = []    #start and end times of every plugin run
+        cycles = []
+        start = time.time()
+        while not services.done() and time.time() - start < args.timeout:
+            cycleStart = time.time()
+            pollcat.mainloop()
+            cycles.append(time.time() - cycleStart)
+            time.sleep(pollcat.sleepTime())
+        elapsed = time.time() - start
+
+        delivered = [r for r in services.requests if r.completedAt is not None]
+        print
+        print "Delivered %i/%i requests in %.1fs" % (len(delivered), len(services.requests), elapsed)
+        print summary("cycle latency", cycles)
+        print summary("time-to-delivery", [r.completedAt - max(r.readyAt, start) for r in delivered])
+
+        if args.plugin != 'none':
+            files = sum(metrics.FILES_COPIED.values.values())
+            size = sum(metrics.BYTES_COPIED.values.values())
+            copyTime = max(copying) - min(copying) if copying else 0
+            print "%-18s %i files, %.1f MB, %.1f files/s, %.1f MB/s" % (
+                "copy throughput", files, size / 1e6,
+                files / max(copyTime, 0.001), size / 1e6 / max(copyTime, 0.001)
+            )
+
+        print "%-18s %s" % ("calls", ", ".join("%s=%i" % item for item in sorted(services.calls.items())))
+        services.server.shutdown()
+    finally:
+        shutil.rmtree(workdir, True)
+
+
+if __name__ == "__main__":
+    main()
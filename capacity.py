@@ -0,0 +1,108 @@
+import os
+import threading
+
+"""
+Capacity admission for PollCAT plugins
+
+Before a plugin starts copying a request it asks the CapacityGate whether
+the request fits: the free space on the destination filesystem, less a
+margin and less what requests already admitted have still to copy, must
+hold it, and so must the user's quota if one is set. A request that fits
+has its size reserved until it is released; one that doesn't is turned
+away with the reason, which the plugin raises as RequestDeferred so that
+pollcat tries it again later instead of filling the disk part way through.
+"""
+
+def gigabytes(size):
+    return "%.1fGB" % (size / 1e9)
+
+
+def usage(path):
+    """
+    Return the bytes allocated to the files under path
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+class CapacityGate(object):
+    """
+    Reserves space on the destination filesystems for the requests being
+    copied to them, shared by every request a plugin delivers
+    """
+
+    def __init__(self, margin, userQuota, logger):
+        """
+        Parameters:
+            margin - bytes to always leave free
+            userQuota - the most bytes one user's downloads may take up,
+                        or 0 for no quota
+        """
+        self.margin = margin
+        self.userQuota = userQuota
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.reservations = {}  #key:[st_dev, user, bytes still to copy]
+
+
+    def admit(self, key, path, size, user=None, home=None):
+        """
+        Reserve size bytes for a request if it fits, replacing any earlier
+        reservation under the same key
+
+        Parameters:
+            key - identifies the request, e.g. its preparedId
+            path - the directory the request is copied to, or the nearest
+                   one that exists
+            size - the bytes the request still has to copy
+            user - the user the request is for, for the quota
+            home - the directory holding the user's downloads
+
+        Returns None if the request was admitted, otherwise the reason it
+        doesn't fit.
+        """
+        used = 0
+        if self.userQuota and home is not None and os.path.isdir(home):
+            used = usage(home)
+
+        device = os.stat(path).st_dev
+        with self.lock:
+            self.reservations.pop(key, None)
+            stat = os.statvfs(path)
+            free = stat.f_bavail * stat.f_frsize
+            reserved = sum(remaining for dev, owner, remaining in self.reservations.values() if dev == device)
+            if size + reserved + self.margin > free:
+                if size + self.margin > stat.f_blocks * stat.f_frsize:
+                    self.logger.warn("Request %s needs %s, more than %s can ever hold with a %s margin" % (
+                        key, gigabytes(size), path, gigabytes(self.margin)))
+                return "needs %s but %s has %s free and %s reserved" % (
+                    gigabytes(size), path, gigabytes(free), gigabytes(reserved))
+
+            if self.userQuota and user is not None:
+                used += sum(remaining for dev, owner, remaining in self.reservations.values() if owner == user)
+                if used + size > self.userQuota:
+                    return "needs %s but %s is using %s of a %s quota" % (
+                        gigabytes(size), user, gigabytes(used), gigabytes(self.userQuota))
+
+            self.reservations[key] = [device, user, size]
+        return None
+
+
+    def consume(self, key, size):
+        """
+        Reduce a request's reservation by size bytes it has now copied
+        """
+        with self.lock:
+            if key in self.reservations:
+                self.reservations[key][2] = max(self.reservations[key][2] - size, 0)
+
+
+    def release(self, key):
+        with self.lock:
+            self.reservations.pop(key, None)
@@ -1,5 +1,13 @@
-import icat
-import icat.client
+import os
+import re
+import json
+import time
+import threading
+import Queue
+import metrics
+
+# python-icat (and suds beneath it) is slow to import, so it is only
+# imported when the first ICAT session is needed
 
 
 class IcatClient(object):
@@ -7,22 +15,180 @@ class IcatClient(object):
     Simple wrapper around python-icat that checks to see if session
     is valid before returning the client. If it has expired, a new
     session in initiated.
+
+    All IcatClients for the same ICAT and user share one IcatSession, so
+    the plugins reuse the main loop's session rather than logging in again.
     """
 
     def __init__(self, config):
         self.config = config
+        self.session = getSession(config)
 
     def getInstance(self):
+        return self.session.getClient()
+
+    def invalidate(self):
+        """
+        Force a new login, e.g. after ICAT rejected the session
+        """
+        self.session.invalidate()
+
+
+_sessions = {}  #(ICAT_URL, ICAT_USER):IcatSession
+_sessionsLock = threading.Lock()
+
+
+def getSession(config):
+    """
+    Return the process wide IcatSession for the configured ICAT and user
+    """
+    key = (config.get('main', 'ICAT_URL'), config.get('main', 'ICAT_USER'))
+    with _sessionsLock:
+        if key not in _sessions:
+            _sessions[key] = IcatSession(config)
+        return _sessions[key]
+
+
+class IcatSession(object):
+    """
+    A logged in python-icat client whose expiry is tracked locally. The
+    session is only refreshed once it is within ICAT_REFRESH_MARGIN seconds
+    of expiring, and a lost session is recovered by logging in again on the
+    same client, which avoids fetching and parsing the WSDL again.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.icatclient = None
+        self.lifetime = 0   #seconds a session lasts after login or refresh
+        self.expires = 0    #when the current session runs out
+
+    def getClient(self):
+        with self.lock:
+            now = time.time()
+            if self.icatclient is None or self.icatclient.sessionId is None:
+                self.login()
+            elif now >= self.expires - float(self.config.get('main', 'ICAT_REFRESH_MARGIN')):
+                try:
+                    with metrics.timed(metrics.CALL_SECONDS, service='icat', endpoint='refresh'):
+                        self.icatclient.refresh()
+                    metrics.CALLS.inc(service='icat', endpoint='refresh', status='ok')
+                    self.expires = now + self.lifetime
+                except:
+                    metrics.CALLS.inc(service='icat', endpoint='refresh', status='error')
+                    self.login()
+            return self.icatclient
+
+    def login(self):
+        credentials = {
+            'username' : self.config.get('main', 'ICAT_USER'),
+            'password' : self.config.get('main', 'ICAT_PASSWD').decode("utf8")
+        }
+        with metrics.timed(metrics.CALL_SECONDS, service='icat', endpoint='login'):
+            try:
+                self.icatclient.login('db', credentials)
+            except:
+                # no client yet, or it no longer works with the server
+                self.icatclient = createClient(self.config)
+                self.icatclient.login('db', credentials)
+            self.lifetime = self.icatclient.getRemainingMinutes() * 60
+            self.expires = time.time() + self.lifetime
+        metrics.CALLS.inc(service='icat', endpoint='login', status='ok')
+
+    def invalidate(self):
+        with self.lock:
+            self.expires = 0
+            if self.icatclient is not None:
+                self.icatclient.sessionId = None
+
+
+def createClient(config):
+    """
+    Build a python-icat client. If ICAT_WSDL_CACHE is set, the parsed WSDL
+    is kept there in a directory per ICAT version, so that only the first
+    client for each version of ICAT has to download and parse it.
+    """
+    import icat.client
+    from suds.cache import ObjectCache
+
+    url = config.get('main', 'ICAT_URL') + "/ICATService/ICAT?wsdl"
+    cachedir = config.get('main', 'ICAT_WSDL_CACHE')
+    if cachedir:
+        version = getIcatVersion(config)
+        if version is not None:
+            cache = ObjectCache(os.path.join(cachedir, re.sub('[^\w.-]', '_', version)), days=365)
+            return icat.client.Client(url, cache=cache)
+    return icat.client.Client(url)
+
+
+def getIcatVersion(config):
+    """
+    Ask ICAT's REST interface for its version, without needing the WSDL.
+    Returns None if ICAT doesn't answer.
+    """
+    from httpclient import getClient
+    try:
+        response = getClient(config).get('icat', '/icat/version')
+        response.raise_for_status()
+        return json.loads(response.text)['version']
+    except Exception:
+        return None
+
+
+def icatSearch(icatclient, query):
+    """
+    Run an ICAT search, recording it in the metrics. If ICAT has dropped
+    the session the search is retried once with a new login.
+
+    Parameters:
+        icatclient - an IcatClient
+        query - a JPQL query string
+    """
+    from icat.exception import ICATSessionError
+
+    for attempt in range(2):
+        client = icatclient.getInstance()
         try:
-            self.icatclient.refresh()
+            with metrics.timed(metrics.CALL_SECONDS, service='icat', endpoint='search'):
+                results = client.search(query)
+        except ICATSessionError:
+            metrics.CALLS.inc(service='icat', endpoint='search', status='error')
+            if attempt:
+                raise
+            icatclient.invalidate()
+            continue
         except:
-            url = self.config.get('main', 'ICAT_URL') + "/ICATService/ICAT?wsdl"
-            self.icatclient = icat.client.Client(url)
-            self.icatclient.login('db', {
-                'username' : self.config.get('main', 'ICAT_USER'),
-                'password' : self.config.get('main', 'ICAT_PASSWD').decode("utf8")
-            })
-        return self.icatclient
+            metrics.CALLS.inc(service='icat', endpoint='search', status='error')
+            raise
+        metrics.CALLS.inc(service='icat', endpoint='search', status='ok')
+        return results
+
+
+class Background(object):
+    """
+    Run func(*args) on its own thread straight away. result() waits for it
+    to finish and returns its value, or re-raises its exception.
+    """
+
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(func, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, func, args):
+        try:
+            self.value = func(*args)
+        except Exception, e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
 
 
 def chunks(l, n):
@@ -37,3 +203,112 @@ def chunks(l, n):
         n - the chunk size
     """
     return [",".join(str(j) for j in l[i:i + n]) for i in range(0, len(l), n)]
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable on a background thread, which stays up to depth
+    items ahead of the caller, e.g. to run the next ICAT query while the
+    results of the last are being used. An exception raised by iterable is
+    re-raised to the caller in its place.
+
+    Parameters:
+        iterable - the items to fetch, usually a generator
+        depth - the most items fetched but not yet used
+    """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # give up if the caller stops iterating
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception, e:
+            put((end, e))
+            return
+        put((end, None))
+
+    producer = threading.Thread(target=produce, name="prefetch")
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def fanout(func, items, concurrency):
+    """
+    Call func(item) for every item using up to concurrency threads, in the
+    order given. As soon as any call returns a false value no further calls
+    are started, although calls already in flight are allowed to finish.
+    The first exception raised by func is re-raised once all threads have
+    stopped.
+
+    fanout(isOnline, ["1,2", "3,4", "5,6"], 2) -> [True, False, None]
+
+    Parameters:
+        func - a function of one argument
+        items - a list of arguments for func
+        concurrency - the maximum number of calls in flight at once
+
+    Returns a list of the results in item order, with None for any item
+    that was never called.
+    """
+    results = [None] * len(items)
+
+    if concurrency <= 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            results[i] = func(item)
+            if not results[i]:
+                break
+        return results
+
+    pending = Queue.Queue()
+    for i in range(len(items)):
+        pending.put(i)
+    stop = threading.Event()
+    errors = []
+
+    def worker():
+        while not stop.is_set():
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception, e:
+                errors.append(e)
+                stop.set()
+                return
+            if not results[i]:
+                stop.set()
+
+    threads = [threading.Thread(target=worker) for i in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,82 @@
+"""
+Polling engines for PollCAT
+
+The engine decides how the main loop runs the checks that are due. The
+plugins always run on the workers' real threads. ENGINE in pollcat.config
+selects one:
+
+threads - the default. Due requests are checked one after another in the
+          main thread and plugins run in the worker threads.
+
+gevent  - pollcat.py monkey patches the standard library with gevent before
+          anything else is imported, so every socket wait in requests or
+          python-icat yields to other greenlets. Due requests are checked
+          ENGINE_CONCURRENCY at a time as greenlets, letting one process
+          keep thousands of status calls in flight. threading is not
+          patched, so the workers, the outbox and the plugins' own copy
+          threads stay real threads, and Plugin.run() blocking on disk or
+          subprocesses never holds up the greenlets. Requires gevent to be
+          installed.
+
+(pollcat runs on Python 2, where asyncio is not available; gevent gives
+the same single-process coroutine model without rewriting the blocking
+TopCAT, IDS and ICAT calls.)
+"""
+
+def getEngine(config, logger):
+    """
+    Create the engine named by ENGINE in pollcat.config
+    """
+    name = config.get('main', 'ENGINE')
+    if name == 'threads':
+        return ThreadEngine()
+    if name == 'gevent':
+        return GeventEngine(int(config.get('main', 'ENGINE_CONCURRENCY')))
+    raise ValueError("Unknown engine: %s" % name)
+
+
+def patch():
+    """
+    Monkey patch the standard library for the gevent engine. Must be called
+    before socket, ssl, threading or anything using them is imported.
+    """
+    from gevent import monkey
+    # threading is left alone: the plugins run on gevent's real threads,
+    # where greenlet locks, queues and events belong to another thread's
+    # hub and fail with LoopExit
+    monkey.patch_all(thread=False)
+
+
+class ThreadEngine(object):
+    """
+    Plain blocking engine
+    """
+
+    def map(self, func, items):
+        for item in items:
+            func(item)
+
+
+class GeventEngine(object):
+    """
+    Runs checks as greenlets
+    """
+
+    def __init__(self, concurrency):
+        """
+        Parameters:
+            concurrency - the number of checks to run at once
+        """
+        import gevent.pool
+
+        self.pool = gevent.pool.Pool(concurrency)
+
+
+    def map(self, func, items):
+        """
+        Call func(item) for every item, at most concurrency at a time, and
+        wait for them all to finish
+        """
+        for item in items:
+            self.pool.spawn(func, item)
+        self.pool.join()
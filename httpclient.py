@@ -0,0 +1,119 @@
+import threading
+import metrics
+
+# requests is imported when the first session is created, so that
+# importing pollcat doesn't wait for it
+
+"""
+Shared HTTP client for PollCAT
+
+Keeps one requests.Session per service (TopCAT, the IDS and ICAT's REST
+interface) so that connections, including TLS sessions, are pooled and
+kept alive between calls instead of being set up again for every
+getStatus chunk. Each session is created on the service's first call.
+Plugins that need to talk to TopCAT or the IDS should use getClient()
+rather than calling requests directly.
+"""
+
+# service name : config option holding its base url
+SERVICES = {
+    'topcat' : 'TOPCAT_URL',
+    'ids'    : 'IDS_URL',
+    'icat'   : 'ICAT_URL'
+}
+
+# transient errors worth retrying
+RETRY_STATUSES = (502, 503, 504)
+
+_client = None
+_clientLock = threading.Lock()
+
+
+def getClient(config):
+    """
+    Return the process wide HttpClient, creating it on first use
+    """
+    global _client
+    with _clientLock:
+        if _client is None:
+            _client = HttpClient(config)
+        return _client
+
+
+class HttpClient(object):
+    """
+    Pooled, keep-alive HTTP sessions for the services pollcat talks to
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timeout = float(config.get('main', 'HTTP_TIMEOUT'))
+        self.lock = threading.Lock()
+        self.sessions = {}  #service:requests.Session
+
+
+    def getSession(self, service):
+        with self.lock:
+            if service not in self.sessions:
+                self.sessions[service] = self.createSession()
+            return self.sessions[service]
+
+
+    def createSession(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        retries = Retry(
+            total=int(self.config.get('main', 'HTTP_RETRIES')),
+            backoff_factor=float(self.config.get('main', 'HTTP_BACKOFF')),
+            status_forcelist=RETRY_STATUSES
+        )
+        poolsize = int(self.config.get('main', 'HTTP_POOL_SIZE'))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize, max_retries=retries)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    def url(self, service, path):
+        return self.config.get('main', SERVICES[service]).rstrip('/') + path
+
+
+    def request(self, method, service, path, timeout=None, **kwargs):
+        """
+        Make a request to one of the SERVICES
+
+        Parameters:
+            method - the HTTP method, e.g. 'GET'
+            service - a key of SERVICES, e.g. 'ids'
+            path - the path of the endpoint, e.g. '/ids/getStatus'
+            timeout - seconds to wait, defaults to HTTP_TIMEOUT
+            kwargs - passed on to requests
+        """
+        session = self.getSession(service)
+        import requests
+
+        if timeout is None:
+            timeout = self.timeout
+        labels = {'service' : service, 'endpoint' : metrics.endpoint(path)}
+        try:
+            with metrics.timed(metrics.CALL_SECONDS, **labels):
+                response = session.request(
+                    method, self.url(service, path), timeout=timeout, **kwargs
+                )
+        except requests.RequestException:
+            metrics.CALLS.inc(status='error', **labels)
+            raise
+        metrics.CALLS.inc(status=str(response.status_code), **labels)
+        return response
+
+
+    def get(self, service, path, timeout=None, **kwargs):
+        return self.request('GET', service, path, timeout, **kwargs)
+
+
+    def put(self, service, path, timeout=None, **kwargs):
+        return self.request('PUT', service, path, timeout, **kwargs)
@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import threading
+
+"""
+Datafile id cache for PollCAT
+
+The list of datafile ids behind a preparedId never changes, so it only
+needs fetching from the IDS once. Lists are kept in memory with least
+recently used eviction and, if a directory is given, also written to disk
+as <preparedId>.json so they survive a restart.
+"""
+
+class DatafileIdCache(object):
+    """
+    LRU cache of preparedId -> list of datafile ids
+    """
+
+    def __init__(self, size, directory=None):
+        """
+        Parameters:
+            size - the number of requests to hold in memory
+            directory - where to persist the lists, None to keep them in memory only
+        """
+        self.size = size
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}   #preparedId:datafileIds
+        self.used = {}      #preparedId:tick of its last use, for the LRU order
+        self.tick = 0
+
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+
+    def path(self, preparedId):
+        if re.match('^[\w-]+$', preparedId) == None:
+            raise ValueError("preparedId contains non-alphanumeric characters")
+        return os.path.join(self.directory, preparedId + '.json')
+
+
+    def touch(self, preparedId):
+        # called with the lock held
+        self.tick += 1
+        self.used[preparedId] = self.tick
+
+
+    def get(self, preparedId):
+        """
+        Return the cached datafile ids for preparedId, or None
+        """
+        with self.lock:
+            if preparedId in self.entries:
+                self.touch(preparedId)
+                return self.entries[preparedId]
+
+        if self.directory and os.path.exists(self.path(preparedId)):
+            with open(self.path(preparedId)) as f:
+                datafileIds = json.load(f)
+            self.remember(preparedId, datafileIds)
+            return datafileIds
+        return None
+
+
+    def put(self, preparedId, datafileIds):
+        if self.directory:
+            # write then rename so a crash never leaves a truncated list behind
+            temp = self.path(preparedId) + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(datafileIds, f)
+            os.rename(temp, self.path(preparedId))
+        self.remember(preparedId, datafileIds)
+
+
+    def remember(self, preparedId, datafileIds):
+        with self.lock:
+            self.entries[preparedId] = datafileIds
+            self.touch(preparedId)
+            while len(self.entries) > self.size:
+                oldest = min(self.used, key=self.used.get)
+                del self.entries[oldest]
+                del self.used[oldest]
+
+
+    def evict(self, preparedId):
+        with self.lock:
+            self.entries.pop(preparedId, None)
+            self.used.pop(preparedId, None)
+        if self.directory and os.path.exists(self.path(preparedId)):
+            os.remove(self.path(preparedId))
+
+
+    def retain(self, preparedIds):
+        """
+        Evict every request not in preparedIds, in memory and on disk
+
+        Parameters:
+            preparedIds - the preparedIds from the latest TopCAT listing
+        """
+        keep = set(preparedIds)
+        with self.lock:
+            for preparedId in set(self.entries).difference(keep):
+                del self.entries[preparedId]
+                del self.used[preparedId]
+
+        if self.directory:
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.json') and filename[:-len('.json')] not in keep:
+                    os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,189 @@
+import json
+import time
+import sqlite3
+import threading
+
+from workers import COPYING
+
+"""
+Job journal for PollCAT
+
+A small SQLite database recording how far each download request has got,
+so that a restarted pollcat carries on where it stopped instead of starting
+again from scratch:
+
+    requests  - one row per request handed to the workers, with its TopCAT
+                request, its datafile ids and its state (READY, COPYING or
+                COMPLETING)
+    datafiles - one row per datafile the plugin has finished copying
+    downloads - the download name a plugin chose for a request, where it
+                may differ from the one in TopCAT
+
+A request's rows are removed once TopCAT has accepted it as COMPLETE.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    preparedId  TEXT PRIMARY KEY,
+    request     TEXT NOT NULL,
+    datafileIds TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    updated     REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datafiles (
+    preparedId  TEXT NOT NULL,
+    datafileId  INTEGER NOT NULL,
+    PRIMARY KEY (preparedId, datafileId)
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    preparedId  TEXT PRIMARY KEY,
+    name        TEXT NOT NULL
+);
+"""
+
+class Journal(object):
+    """
+    Durable record of in-flight requests, shared by all worker threads
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path - the SQLite database file, created if missing
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+            self.db.commit()
+            return rows
+
+
+    def record(self, request, datafileIds, state):
+        """
+        Start journalling a request. A request already in the journal keeps
+        its state and copied files so that its job can pick up from there.
+        """
+        self.execute(
+            "INSERT OR IGNORE INTO requests VALUES (?, ?, ?, ?, ?)",
+            (request['preparedId'], json.dumps(request), json.dumps(datafileIds), state, time.time())
+        )
+
+
+    def setState(self, preparedId, state):
+        self.execute(
+            "UPDATE requests SET state = ?, updated = ? WHERE preparedId = ?",
+            (state, time.time(), preparedId)
+        )
+
+
+    def state(self, preparedId):
+        """
+        Return the journalled state of a request, or None
+        """
+        rows = self.execute("SELECT state FROM requests WHERE preparedId = ?", (preparedId,))
+        if rows:
+            return rows[0][0]
+        return None
+
+
+    def entries(self):
+        """
+        Return (request, datafileIds, state) for every journalled request
+        """
+        rows = self.execute("SELECT request, datafileIds, state FROM requests ORDER BY updated")
+        return [(json.loads(request), json.loads(datafileIds), state) for request, datafileIds, state in rows]
+
+
+    def markCopied(self, preparedId, datafileId):
+        self.execute("INSERT OR IGNORE INTO datafiles VALUES (?, ?)", (preparedId, datafileId))
+
+
+    def copied(self, preparedId):
+        """
+        Return the set of datafile ids already copied for a request
+        """
+        rows = self.execute("SELECT datafileId FROM datafiles WHERE preparedId = ?", (preparedId,))
+        return set(row[0] for row in rows)
+
+
+    def setDownloadName(self, preparedId, name):
+        self.execute("INSERT OR REPLACE INTO downloads VALUES (?, ?)", (preparedId, name))
+
+
+    def downloadName(self, preparedId):
+        rows = self.execute("SELECT name FROM downloads WHERE preparedId = ?", (preparedId,))
+        if rows:
+            return rows[0][0]
+        return None
+
+
+    def finish(self, preparedId):
+        with self.lock:
+            self.db.execute("DELETE FROM downloads WHERE preparedId = ?", (preparedId,))
+            self.db.execute("DELETE FROM datafiles WHERE preparedId = ?", (preparedId,))
+            self.db.execute("DELETE FROM requests WHERE preparedId = ?", (preparedId,))
+            self.db.commit()
+
+
+    def retain(self, preparedIds):
+        """
+        Drop every request not in preparedIds, e.g. deleted in TopCAT
+
+        Parameters:
+            preparedIds - the preparedIds from the latest TopCAT listing
+        """
+        keep = set(preparedIds)
+        for preparedId in [row[0] for row in self.execute("SELECT preparedId FROM requests")]:
+            if preparedId not in keep:
+                self.finish(preparedId)
+
+        # a request dropped while it was being copied goes on marking files
+        # copied after finish() has removed it
+        with self.lock:
+            self.db.execute("DELETE FROM datafiles WHERE preparedId NOT IN (SELECT preparedId FROM requests)")
+            self.db.execute("DELETE FROM downloads WHERE preparedId NOT IN (SELECT preparedId FROM requests)")
+            self.db.commit()
+
+
+    def forRequest(self, preparedId):
+        return RequestJournal(self, preparedId)
+
+
+class RequestJournal(object):
+    """
+    The part of the journal a plugin sees for the request it is delivering.
+    Plugins call isCopied() to skip files finished before a restart and
+    markCopied() after each file they copy. A plugin that renames a
+    download records the name with setDownloadName() so that a retry
+    carries on in the same place.
+    """
+
+    def __init__(self, journal, preparedId):
+        self.journal = journal
+        self.preparedId = preparedId
+        self.done = journal.copied(preparedId)
+        # True if an earlier attempt at this request started copying
+        self.resuming = len(self.done) > 0 or journal.state(preparedId) == COPYING
+        self.downloadName = journal.downloadName(preparedId)
+
+
+    def isCopied(self, datafileId):
+        return datafileId in self.done
+
+
+    def markCopied(self, datafileId):
+        self.journal.markCopied(self.preparedId, datafileId)
+        self.done.add(datafileId)
+
+
+    def setDownloadName(self, name):
+        self.journal.setDownloadName(self.preparedId, name)
+        self.downloadName = name
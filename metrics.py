@@ -0,0 +1,250 @@
+import os
+import re
+import time
+import threading
+import BaseHTTPServer
+
+"""
+Metrics for PollCAT
+
+A small process wide registry of counters, gauges and histograms, rendered
+in the Prometheus text exposition format. pollcat.py serves it over HTTP on
+METRICS_PORT and/or writes it to METRICS_FILE every METRICS_INTERVAL
+seconds. The metrics pollcat itself records are created at the bottom of
+this module; plugins use the same ones, e.g.
+
+    metrics.FILES_COPIED.inc(plugin='globus')
+
+    with metrics.timed(metrics.CALL_SECONDS, service='icat', endpoint='search'):
+        ...
+
+Copy throughput is the rate of FILES_COPIED and BYTES_COPIED, with
+COPY_RATE holding the bytes per second of each plugin's last request for
+readers of METRICS_FILE.
+"""
+
+# seconds, from a quick HTTP call to a long copy
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_metrics = {}   #name:metric
+_lock = threading.Lock()
+
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    A value that only goes up, e.g. calls made
+    """
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}    #labelKey:value
+
+
+    def inc(self, amount=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def render(self):
+        with self.lock:
+            return ['%s%s %s' % (self.name, formatLabels(key), formatValue(value))
+                    for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down, e.g. pending requests
+    """
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[labelKey(labels)] = value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values, e.g. call latency
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.lock = threading.Lock()
+        self.values = {}    #labelKey:[bucket counts, sum, count]
+
+
+    def observe(self, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %i' % (self.name, formatLabels(key, [('le', formatValue(bound))]), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, formatLabels(key), formatValue(total)))
+                lines.append('%s_count%s %i' % (self.name, formatLabels(key), count))
+        return lines
+
+
+def register(cls, name, help, *args):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, help, *args)
+        return _metrics[name]
+
+
+def counter(name, help):
+    return register(Counter, name, help)
+
+
+def gauge(name, help):
+    return register(Gauge, name, help)
+
+
+def histogram(name, help, buckets=BUCKETS):
+    return register(Histogram, name, help, buckets)
+
+
+class timed(object):
+    """
+    Context manager observing the seconds spent in its block
+    """
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+def endpoint(path):
+    """
+    Turn a request path into a label, replacing ids so that e.g. every
+    /topcat/admin/download/<id>/status call shares one time series
+    """
+    return re.sub('/\d+', '/{id}', path)
+
+
+def render():
+    """
+    Return every metric in the Prometheus text format
+    """
+    lines = []
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda m: m.name)
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """
+    Serve /metrics on port from a background thread
+    """
+    server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump(path, interval, logger):
+    """
+    Write the metrics to path every interval seconds from a background thread
+    """
+    def write():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(render())
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError), err:
+                logger.warn("Unable to write metrics to %s: %s" % (path, err))
+
+    thread = threading.Thread(target=write, name="metrics-dump")
+    thread.daemon = True
+    thread.start()
+
+
+CYCLE_SECONDS = histogram('pollcat_cycle_seconds', 'Duration of each main loop pass')
+PENDING_REQUESTS = gauge('pollcat_pending_requests', 'Requests waiting for their files to be ONLINE')
+CALLS = counter('pollcat_calls_total', 'Calls made to TopCAT, the IDS and ICAT')
+CALL_SECONDS = histogram('pollcat_call_seconds', 'Latency of calls to TopCAT, the IDS and ICAT')
+STATUS_CHUNKS = histogram('pollcat_status_chunks', 'getStatus chunks requested per readiness check',
+                          (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+FILES_COPIED = counter('pollcat_files_copied_total', 'Files copied by the plugin')
+BYTES_COPIED = counter('pollcat_bytes_copied_total', 'Bytes copied by the plugin')
+COPY_RATE = gauge('pollcat_copy_bytes_per_second', 'Copy throughput of the last request delivered')
+FILES_SKIPPED = counter('pollcat_files_skipped_total', 'Files already delivered by an earlier attempt')
+CHECKSUM_MISMATCHES = counter('pollcat_checksum_mismatches_total', 'Copies that did not match their ICAT checksum')
+STORE_HITS = counter('pollcat_store_hits_total', 'Files linked from the shared store instead of copied')
+DEFERRED_REQUESTS = counter('pollcat_deferred_requests_total', 'Requests the plugin deferred, e.g. for lack of space')
+THROTTLE_SECONDS = counter('pollcat_throttle_seconds_total', 'Seconds copies waited for the I/O governor')
+PLUGIN_FAILURES = counter('pollcat_plugin_failures_total', 'Requests the plugin failed to deliver')
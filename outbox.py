@@ -0,0 +1,111 @@
+import time
+import threading
+
+from common import fanout
+from workers import COMPLETING
+
+"""
+Completion outbox for PollCAT
+
+Once the plugin has delivered a request, telling TopCAT it is COMPLETE is
+left to the outbox rather than done inline. The request is already
+journalled as COMPLETING, so the update survives a restart. A background
+thread sends the due updates, several at a time, and retries failures
+with exponential backoff. Requests in the outbox are never handed to the
+plugin again, so a slow or failing TopCAT no longer costs a full recopy.
+"""
+
+class CompletionOutbox(object):
+    """
+    Queue of requests waiting for TopCAT to accept their COMPLETE update
+    """
+
+    def __init__(self, journal, send, concurrency, retryDelay, maxDelay, logger):
+        """
+        Parameters:
+            journal - the journal.Journal holding the COMPLETING requests
+            send - function(preparedId, downloadId) making the update,
+                   raising an exception if TopCAT didn't accept it
+            concurrency - the number of updates to send at once
+            retryDelay - seconds before the first retry of a failed update
+            maxDelay - the most seconds between retries
+        """
+        self.journal = journal
+        self.send = send
+        self.concurrency = concurrency
+        self.retryDelay = retryDelay
+        self.maxDelay = maxDelay
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.entries = {}   #preparedId:[downloadId, failures, next attempt]
+
+        for request, datafileIds, state in journal.entries():
+            if state == COMPLETING:
+                self.logger.info("Request %s still needs marking as complete" % request['preparedId'])
+                self.entries[request['preparedId']] = [request['id'], 0, 0]
+
+        sender = threading.Thread(target=self.work, name="outbox")
+        sender.daemon = True
+        sender.start()
+
+
+    def add(self, preparedId, downloadId):
+        """
+        Queue the COMPLETE update for a request the journal has as COMPLETING
+        """
+        with self.lock:
+            self.entries[preparedId] = [downloadId, 0, 0]
+        self.wakeup.set()
+
+
+    def isPending(self, preparedId):
+        with self.lock:
+            return preparedId in self.entries
+
+
+    def retain(self, preparedIds):
+        """
+        Drop updates for requests TopCAT no longer lists as RESTORING
+
+        Parameters:
+            preparedIds - the preparedIds from the latest TopCAT listing
+        """
+        with self.lock:
+            for preparedId in set(self.entries).difference(preparedIds):
+                del self.entries[preparedId]
+
+
+    def deliver(self, preparedId):
+        with self.lock:
+            if preparedId not in self.entries:
+                return True
+            downloadId = self.entries[preparedId][0]
+        try:
+            self.send(preparedId, downloadId)
+            with self.lock:
+                self.entries.pop(preparedId, None)
+        except Exception:
+            with self.lock:
+                if preparedId in self.entries:
+                    entry = self.entries[preparedId]
+                    entry[1] += 1
+                    entry[2] = time.time() + min(self.retryDelay * 2 ** (entry[1] - 1), self.maxDelay)
+                    self.logger.warn("Unable to mark request %s as complete (attempt %i), retrying in %is" % (
+                        preparedId, entry[1], entry[2] - time.time()), exc_info=True)
+        # always carry on with the other updates
+        return True
+
+
+    def work(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            with self.lock:
+                due = [p for p, entry in self.entries.items() if entry[2] <= now]
+                waits = [entry[2] - now for entry in self.entries.values() if entry[2] > now]
+            if due:
+                fanout(self.deliver, due, self.concurrency)
+                continue
+
+            self.wakeup.wait(min(waits) if waits else None)
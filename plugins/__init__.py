@@ -0,0 +1,125 @@
+import copy
+import importlib
+
+"""
+PollCAT plugins
+
+A plugin lives in plugins/<name>/<name>.py and provides a class called
+Plugin. The original contract is still supported: pollcat may build one
+Plugin(request, datafileIds, config, logger) per request and call run().
+
+Plugins that subclass PluginBase get a lifecycle instead. pollcat builds a
+single instance at start up, which calls setup() once to read config and
+open connections, then calls process(request, datafileIds) for every
+request and teardown() when the daemon stops. Each process() call runs on
+a shallow copy of the instance, so requests delivered in parallel share
+the warm resources from setup() but have their own per-request state,
+which reset() creates. process() is also given the request's journal and,
+when pollcat has summed it in ICAT, its size in bytes, so the plugin
+needn't ask ICAT again.
+
+A plugin that can't deliver a request yet, e.g. because there isn't room
+for it, raises RequestDeferred. pollcat checks the request again after
+DEFER_DELAY seconds rather than counting it as a failure.
+"""
+
+class RequestDeferred(Exception):
+    """
+    Raised by a plugin to have a request delivered later
+    """
+    pass
+
+
+class PluginBase(object):
+    """
+    Base class for long-lived plugins
+    """
+
+    def __init__(self, request, datafileIds, config, logger):
+        self.config = config
+        self.logger = logger
+        self.setup()
+        self.begin(request, datafileIds)
+
+
+    def setup(self):
+        """
+        Read config and open connections, once for the life of the plugin
+        """
+        pass
+
+
+    def reset(self):
+        """
+        Create the per-request state used by run()
+        """
+        pass
+
+
+    def begin(self, request, datafileIds, journal=None, size=None):
+        self.request = request
+        self.datafileIds = datafileIds
+        self.journal = journal     # a journal.RequestJournal, or None
+        self.size = size           # bytes in the request, or None
+        self.reset()
+
+
+    def process(self, request, datafileIds, journal=None, size=None):
+        """
+        Deliver one request
+        """
+        job = copy.copy(self)
+        job.begin(request, datafileIds, journal, size)
+        job.run()
+
+
+    def run(self):
+        """
+        Deliver self.request
+        """
+        raise NotImplementedError
+
+
+    def teardown(self):
+        """
+        Release whatever setup() opened
+        """
+        pass
+
+
+class LegacyPlugin(object):
+    """
+    Gives a plugin that only has the Plugin(...).run() contract the same
+    interface as a PluginBase
+    """
+
+    def __init__(self, plugin_class, config, logger):
+        self.plugin_class = plugin_class
+        self.config = config
+        self.logger = logger
+
+
+    def process(self, request, datafileIds, journal=None, size=None):
+        plugin = self.plugin_class(request, datafileIds, self.config, self.logger)
+        plugin.journal = journal
+        plugin.size = size
+        plugin.run()
+
+
+    def teardown(self):
+        pass
+
+
+def loadPlugin(name, config, logger):
+    """
+    Import plugins/<name>/<name>.py and return a long-lived plugin with
+    process() and teardown() methods
+    """
+    module = importlib.import_module("plugins." + name + "." + name)
+    return wrapPlugin(getattr(module, 'Plugin'), config, logger)
+
+
+def wrapPlugin(plugin_class, config, logger):
+    if issubclass(plugin_class, PluginBase):
+        return plugin_class(None, None, config, logger)
+    return LegacyPlugin(plugin_class, config, logger)
@@ -1,9 +1,16 @@
 import re
 import os
 import icat
-import shutil
+import time
+import metrics
 
 from common import *
+from plugins import PluginBase, RequestDeferred
+from transfer import CopyEngine, Copier, isIdentical
+from store import SharedStore, device
+from capacity import CapacityGate
+from throttle import getGovernor
+from archive import ArchiveWriter
 
 """
 Globus Plugin for PollCAT
@@ -11,25 +18,84 @@ Globus Plugin for PollCAT
 This plugin will create a local unix user account and copy the
 requested files to thier home directory under the download name
 specificed in the TopCAT download request.
-"""
 
-class Plugin(object):
+Requests of ARCHIVE_THRESHOLD files or more are delivered as tar files
+in the download directory instead of as individual files.
+"""
 
-    def __init__(self, request, datafileIds, config, logger):
-        self.request = request
-        self.datafileIds = datafileIds
-        self.config = config
-        self.logger = logger
+class Plugin(PluginBase):
 
-        self.icatclient = IcatClient(config)
+    def setup(self):
+        self.icatclient = IcatClient(self.config)
 
         # merge globus config with main pollcat config
         self.config.read('plugins/globus/globus.config')
 
+        self.algorithm = self.config.get('globus', 'CHECKSUM_ALGORITHM')
+        copier = self.createCopier(self.config.get('globus', 'COPY_STRATEGIES').split(','))
+        self.copier = copier
+        self.copyEngine = CopyEngine(
+            int(self.config.get('globus', 'COPY_THREADS')),
+            int(self.config.get('globus', 'COPY_FS_CONCURRENCY')),
+            copier,
+            self.logger
+        )
+
+        self.store = None
+        if self.config.get('globus', 'STORE') and \
+                device(self.config.get('globus', 'STORE')) != device(self.config.get('globus', 'DESTINATION')):
+            # entries are hardlinked into the downloads, which fails with EXDEV
+            self.logger.warn("Not using the store, %s isn't on the same filesystem as %s" % (
+                self.config.get('globus', 'STORE'), self.config.get('globus', 'DESTINATION')))
+        elif self.config.get('globus', 'STORE'):
+            if 'hardlink' in copier.strategies:
+                # store entries are made read only, which would change the
+                # archived file too
+                self.logger.warn("Not using the hardlink copy strategy to fill the store")
+                copier = self.createCopier([s for s in copier.strategies if s != 'hardlink'])
+            self.store = SharedStore(
+                self.config.get('globus', 'STORE'),
+                copier,
+                float(self.config.get('globus', 'STORE_COLLECT_INTERVAL')),
+                self.logger
+            )
+
+        self.incremental = self.config.getboolean('globus', 'INCREMENTAL_COPY')
+        self.compareChecksums = self.config.getboolean('globus', 'COMPARE_CHECKSUMS')
+
+        self.capacity = None
+        if self.config.getboolean('globus', 'CAPACITY_CHECK'):
+            self.capacity = CapacityGate(
+                int(self.config.get('globus', 'FREE_SPACE_MARGIN')),
+                int(self.config.get('globus', 'USER_QUOTA')),
+                self.logger
+            )
+
+
+    def createCopier(self, strategies):
+        verify = self.config.getboolean('globus', 'VERIFY_CHECKSUMS')
+        return Copier(
+            ','.join(strategies),
+            self.logger,
+            self.algorithm if verify else None,
+            int(self.config.get('globus', 'CHECKSUM_RETRIES')),
+            getGovernor(self.config, self.logger)
+        )
+
 
     def run(self):
         self.createuser(self.request['userName'])
-        self.copydata(self.request['userName'], self.request['fileName'], self.datafileIds)
+        threshold = int(self.config.get('globus', 'ARCHIVE_THRESHOLD'))
+        try:
+            if threshold and len(self.datafileIds) >= threshold:
+                self.archivedata(self.request['userName'], self.request['fileName'], self.datafileIds)
+            else:
+                self.copydata(self.request['userName'], self.request['fileName'], self.datafileIds)
+        finally:
+            if self.capacity is not None:
+                self.capacity.release(self.request['preparedId'])
+        if self.store is not None:
+            self.store.maybeCollect()
 
 
     def createuser(self, username):
@@ -54,20 +120,178 @@ class Plugin(object):
         SOURCE = self.config.get('globus', 'SOURCE')
         DESTINATION = self.config.get('globus', 'DESTINATION')
     
-        if os.path.exists(DESTINATION + '/' + username + '/' + downloadname):
+        resumeName = None
+        if self.journal is not None and self.journal.resuming:
+            resumeName = self.journal.downloadName
+            if resumeName is None and self.journal.done:
+                # journalled before the download name was
+                resumeName = downloadname
+
+        if resumeName is not None:
+            # carry on filling the download started by an earlier attempt,
+            # under the name it chose
+            downloadname = resumeName
+            datafileIds = [dfId for dfId in datafileIds if not self.journal.isCopied(dfId)]
+            self.logger.info("Resuming %s, %i files left to copy" % (downloadname, len(datafileIds)))
+        elif os.path.exists(DESTINATION + '/' + username + '/' + downloadname):
+            if self.incremental:
+                self.logger.info("Download %s already exists, copying only missing or changed files" % downloadname)
+            else:
+                self.logger.warn("Download name already exists. Changing to %s_2" % downloadname)
+                downloadname = downloadname + "_2"
+    
+        if self.capacity is not None:
+            self.admit(username, datafileIds)
+        # only once admitted, as a deferred request may find the name taken
+        # by the time it is tried again
+        if self.journal is not None:
+            self.journal.setDownloadName(downloadname)
+
+        def copied(datafile, size):
+            if self.journal is not None:
+                self.journal.markCopied(datafile.id)
+            if self.capacity is not None:
+                self.capacity.consume(self.request['preparedId'], size)
+            metrics.FILES_COPIED.inc(plugin='globus')
+            metrics.BYTES_COPIED.inc(size, plugin='globus')
+
+        # the next chunks of locations are fetched from ICAT while the
+        # engine's threads copy the files already found. The batch limit
+        # holds the ICAT queries back once the copies fall behind.
+        batch = self.copyEngine.batch(copied, self.copyfile, int(self.config.get('globus', 'COPY_QUEUE')))
+        try:
+            for datafiles in self.locations(datafileIds):
+                for datafile in datafiles:
+                    location = datafile.location
+                    source = "%s/%s" % (SOURCE, location)
+                    destination = "%s/%s/%s/%s" % (DESTINATION, username, downloadname, location)
+                    self.logger.debug("Copying file %s -> %s" % (source, destination))
+                    batch.add(datafile, source, destination)
+        finally:
+            # if ICAT fails part way through, the files already queued are
+            # still copied before the request is given up, so that a retry
+            # never runs alongside them
+            result = batch.wait()
+        metrics.COPY_RATE.set(result.rate(), plugin='globus')
+        self.logger.info("Copied %i files (%i bytes) to %s in %.1fs, %i already there" % (
+            result.files, result.bytes, downloadname, result.seconds, result.skipped))
+        if result.failed:
+            # the files that did copy are journalled, so a retry only
+            # copies the failures
+            raise IOError("%i of %i files for %s failed to copy" % (
+                len(result.failed), result.files + len(result.failed), downloadname))
+
+
+    def locations(self, datafileIds):
+        """
+        Yield the Datafiles from ICAT a chunk at a time, fetching the next
+        chunks in the background
+        """
+        def search():
+            for ids in chunks(datafileIds, int(self.config.get('globus', 'LOCATION_CHUNKS'))):
+                yield icatSearch(self.icatclient, 'SELECT df FROM Datafile df WHERE df.id IN (%s)' % ids)
+
+        return prefetch(search(), int(self.config.get('globus', 'LOCATION_PREFETCH')))
+
+
+    def archivedata(self, username, downloadname, datafileIds):
+        """
+        Write the datafiles into tar files in the download directory, in
+        one sequential pass. A failed attempt is started again from the
+        beginning, so no files are journalled as copied.
+        """
+        SOURCE = self.config.get('globus', 'SOURCE')
+        DESTINATION = self.config.get('globus', 'DESTINATION')
+
+        # an archive can't be topped up, so INCREMENTAL_COPY doesn't apply.
+        # Only a retry, writing to the name journalled by its first attempt,
+        # replaces an existing archive.
+        resuming = self.journal is not None and self.journal.downloadName is not None
+        if resuming:
+            downloadname = self.journal.downloadName
+            self.logger.info("Resuming %s, writing the archive again" % downloadname)
+        elif os.path.exists(DESTINATION + '/' + username + '/' + downloadname):
             self.logger.warn("Download name already exists. Changing to %s_2" % downloadname)
             downloadname = downloadname + "_2"
-    
-        for ids in chunks(datafileIds, int(self.config.get('globus', 'LOCATION_CHUNKS'))):
-            query = 'SELECT df.location FROM Datafile df WHERE df.id IN (%s)' % ids
-            for location in self.icatclient.getInstance().search(query):
-                source = "%s/%s" % (SOURCE, location)
-                destination = "%s/%s/%s/%s" % (DESTINATION, username, downloadname, location)
-    
-                destination_dir = os.path.dirname(destination)
-                if not os.path.isdir(destination_dir):
-                    self.logger.debug("Creating directory %s" % destination_dir)
-                    os.makedirs(destination_dir)
-            
-                self.logger.debug("Copying file %s -> %s" % (source, destination))
-                shutil.copy(source, destination)
+
+        if self.capacity is not None:
+            self.admit(username, datafileIds)
+        # only once admitted, as a deferred request may find the name taken
+        # by the time it is tried again
+        if self.journal is not None:
+            self.journal.setDownloadName(downloadname)
+
+        writer = ArchiveWriter(
+            "%s/%s/%s" % (DESTINATION, username, downloadname),
+            downloadname,
+            self.config.getboolean('globus', 'ARCHIVE_COMPRESS'),
+            int(self.config.get('globus', 'ARCHIVE_SPLIT_SIZE')),
+            self.logger,
+            self.algorithm if self.config.getboolean('globus', 'VERIFY_CHECKSUMS') else None,
+            getGovernor(self.config, self.logger),
+            resuming
+        )
+        start = time.time()
+        copied = 0
+        try:
+            for datafiles in self.locations(datafileIds):
+                for datafile in datafiles:
+                    size = writer.add("%s/%s" % (SOURCE, datafile.location), datafile.location, datafile.checksum)
+                    copied += size
+                    metrics.FILES_COPIED.inc(plugin='globus')
+                    metrics.BYTES_COPIED.inc(size, plugin='globus')
+                    if self.capacity is not None:
+                        self.capacity.consume(self.request['preparedId'], size)
+            parts = writer.close()
+        except:
+            writer.abort()
+            raise
+
+        metrics.COPY_RATE.set(copied / max(time.time() - start, 0.001), plugin='globus')
+        self.logger.info("Archived %i files (%i bytes) for %s into %i parts in %.1fs" % (
+            len(datafileIds), copied, downloadname, len(parts), time.time() - start))
+
+
+    def admit(self, username, datafileIds):
+        """
+        Reserve room on DESTINATION for the datafiles, or raise
+        RequestDeferred if there isn't any. The sizes are summed in ICAT
+        unless they are all still to copy and pollcat passed their total.
+        """
+        size = self.size
+        if size is None or len(datafileIds) != len(self.datafileIds):
+            size = 0
+            for ids in chunks(datafileIds, int(self.config.get('globus', 'LOCATION_CHUNKS'))):
+                total = icatSearch(self.icatclient, 'SELECT SUM(df.fileSize) FROM Datafile df WHERE df.id IN (%s)' % ids)
+                if total and total[0]:
+                    size += int(total[0])
+
+        home = "%s/%s" % (self.config.get('globus', 'DESTINATION'), username)
+        reason = self.capacity.admit(
+            self.request['preparedId'],
+            home if os.path.isdir(home) else self.config.get('globus', 'DESTINATION'),
+            size,
+            username,
+            home
+        )
+        if reason is not None:
+            raise RequestDeferred(reason)
+
+
+    def copyfile(self, datafile, source, destination):
+        """
+        Copy one datafile into the download, from a copy engine thread.
+        Returns False if an identical file was already there.
+        """
+        checksum = datafile.checksum if self.compareChecksums else None
+        if self.incremental and isIdentical(source, destination, checksum, self.algorithm):
+            self.logger.debug("%s is already delivered, skipping" % destination)
+            if self.journal is not None:
+                self.journal.markCopied(datafile.id)
+            metrics.FILES_SKIPPED.inc(plugin='globus')
+            return False
+
+        if self.store is not None:
+            self.store.copy(datafile, source, destination)
+        else:
+            self.copier.copy(source, destination, datafile.checksum)
@@ -1,8 +1,13 @@
 import common
+import metrics
 import re
 import os
-import shutil
+import time
 
+from plugins import PluginBase, RequestDeferred
+from transfer import Copier
+from capacity import CapacityGate
+from throttle import getGovernor
 from plugins.scarf import ldapWrapper
 from plugins.scarf import lsfWrapper
 from icat.exception import ICATError
@@ -11,16 +16,12 @@ from icat.exception import ICATError
 SCARF Plugin for PollCAT
 @author: Shirley Crompton, Research Data Group, SCD
 """
-class Plugin(object):
+class Plugin(PluginBase):
 
-    def __init__(self, request, datafileIds, config, logger):
+    def setup(self):
         '''
-        Initialise class
+        Initialise class, once for the life of the plugin.  The ICAT session, LDAP connection and LSF proxy are shared by every request
         '''
-        self.request = request
-        self.datafileIds = datafileIds
-        self.config = config
-        self.logger = logger
         # merge scarf config with main pollcat config
         self.config.read('plugins/scarf/scarf.config')
         self.destination = self.config.get('scarf','DATA_DESTINATION')        
@@ -29,13 +30,37 @@ class Plugin(object):
         self.dlsDefaultUser = self.config.get('scarf','OS_DLS_DEFUSER') # both for os group and os user
         self.lsfGrpPrefix = self.config.get('scarf','LSF_GRP_PREFIX') #lsf grp pattern <LSF_GRP_PREFIX><icat visitId>, e.g. diag_mt8618-8   
         self.lsfParentGroup = self.config.get('scarf','LSF_PARENT_GRP') #default parent group: diamond     
-         
+        strategies = self.config.get('scarf','COPY_STRATEGIES').split(',')
+        if 'hardlink' in [s.strip() for s in strategies]:
+            #copydata chowns the copies, which would chown the archived files through a hardlink
+            self.logger.warn('The hardlink copy strategy is not safe for SCARF, ignoring it')
+            strategies = [s for s in strategies if s.strip() != 'hardlink']
+        verify = self.config.getboolean('scarf','VERIFY_CHECKSUMS')
+        self.copier = Copier(','.join(strategies), self.logger,
+                             self.config.get('scarf','CHECKSUM_ALGORITHM') if verify else None,
+                             int(self.config.get('scarf','CHECKSUM_RETRIES')),
+                             getGovernor(self.config, self.logger))
+        #check there is room for each request before copying it, deferring the ones that don't fit yet
+        self.capacity = None
+        if self.config.getboolean('scarf','CAPACITY_CHECK'):
+            self.capacity = CapacityGate(int(self.config.get('scarf','FREE_SPACE_MARGIN')), 0, self.logger)
+
+        self.icatClient = common.IcatClient(self.config)
+        self.lsfClient = lsfWrapper.LsfProxy(self.config, self.logger)
+        self.configLdap()
+
+    def reset(self):
+        '''
+        Initialise the per-request state
+        '''
         self.numFilesCopied = 0
         # common variable lists
         self.skippedDFids = []      #int
         self.skippedVisitIds = []   #String
         # common variable maps        
         self.df_locations = {}  #dfId:icat.location  
+        self.df_checksums = {}  #dfId:icat.checksum
+        self.df_sizes = {}      #dfId:icat.fileSize
         self.visitId_dfIds = {} #visitId:[difIds]
         self.visitId_users = {} #visitId:[icat.user]
         self.visitId_uids = {}  #visitId:{scarf.uid}
@@ -46,9 +71,8 @@ class Plugin(object):
         Run the plugin, create the LDAP authorisation structure and LSF account, copy the files across and set file permissions
         
         '''
-        icatClient = common.IcatClient(self.config)
-        self.configLdap()
-        lsfClient = lsfWrapper.LsfProxy(self.config, self.logger)
+        icatClient = self.icatClient
+        lsfClient = self.lsfClient
         
         #1Aug16 updated to handle request user first, if error here, just abort, the exceptions are passed up to pollcat
         #create scarf account for requester if not exist
@@ -76,9 +100,11 @@ class Plugin(object):
                 '''
                 get each file's location
                 '''                
-                datafile = icatClient.getInstance().search('SELECT df FROM Datafile df WHERE df.id=%s' % str(dfId))
+                datafile = common.icatSearch(icatClient, 'SELECT df FROM Datafile df WHERE df.id=%s' % str(dfId))
                 location = datafile[0].location
                 self.df_locations[dfId] = location; #add an entry, each location is unique
+                self.df_checksums[dfId] = datafile[0].checksum
+                self.df_sizes[dfId] = datafile[0].fileSize
             except(ValueError, ICATError), err:
                 self.skippedDFids.append(dfId)
                 self.logger.error("%s retrieving datafile(%i)'s location....Skipping this file" %(err, dfId))
@@ -96,7 +122,7 @@ class Plugin(object):
                     '''
                     get the uids associated with the visitId. Capitalise visitId.
                     '''
-                    uids = icatClient.getInstance().search("SELECT u FROM User u JOIN u.investigationUsers iu JOIN iu.investigation inv WHERE inv.visitId = '%s'" % visitId.upper())
+                    uids = common.icatSearch(icatClient, "SELECT u FROM User u JOIN u.investigationUsers iu JOIN iu.investigation inv WHERE inv.visitId = '%s'" % visitId.upper())
                     if len(uids) > 0:
                         self.visitId_users[visitId] = uids
                     else:
@@ -109,6 +135,8 @@ class Plugin(object):
                     continue
         #finished processing all files in the request.  We have the users associated with the visitId plus each file's location   
         self.logger.info('Finished processing all files in the request.  About to process LDAP entries....')
+        if self.capacity is not None:
+            self.admit()
             
         for vId in self.visitId_users.keys():
             '''
@@ -180,8 +208,7 @@ class Plugin(object):
                 #self.logger.error('Error processing visit(%s): %s.....' %(vId, err))
                 continue            
             
-        #we are done with LDAP now
-        self.proxy.disconnect() 
+        #we are done with LDAP for this request, the connection is kept for the next one until teardown
         self.logger.debug('about to create the OS group/uids and copy files.....')        
         #create the OS group/uids and copy files
         for visitGroup, uids in self.visitId_uids.iteritems():
@@ -266,8 +293,15 @@ class Plugin(object):
         The glassfish group has already been created.  It has 1 user (glassfish, uid = 50548)
         '''
         self.logger.info('Preparing to copy %i files for %s....' %( len(dfIDs), visitID))
-        locations = [self.df_locations[fid] for fid in dfIDs if fid in self.df_locations.keys()]
-        for location in locations:              
+        start = time.time()
+        bytesCopied = 0
+        for fid in dfIDs:
+            if fid not in self.df_locations:
+                continue
+            if self.journal is not None and self.journal.isCopied(fid):
+                self.logger.debug('Datafile(%i) copied by an earlier attempt, skipping....' % fid)
+                continue
+            location = self.df_locations[fid]
             #we will strip the '/dls' segment, the parent path including the 'dls' segment will be defined in the configuration file
             tempPath = location[location.find('dls',0, len(location))+len('dls'):]          #/beamline/data/year/cm12167-3/location1/location2/file.dat
             beamlinePath = self.destination + tempPath[0:tempPath.find('/',1,len(tempPath))] #dls + /beamline 
@@ -285,8 +319,16 @@ class Plugin(object):
         
             self.logger.debug("Copying file %s -> %s" % (source, destination))
             try:
-                shutil.copy(source, destination) #will overwrite if exists
+                self.copier.copy(source, destination, self.df_checksums.get(fid)) #will overwrite if exists
                 self.numFilesCopied += 1
+                size = os.path.getsize(destination)
+                bytesCopied += size
+                metrics.FILES_COPIED.inc(plugin='scarf')
+                metrics.BYTES_COPIED.inc(size, plugin='scarf')
+                if self.capacity is not None:
+                    self.capacity.consume(self.request['preparedId'], size)
+                if self.journal is not None:
+                    self.journal.markCopied(fid)
             except Exception, err:
                 self.logger.warn('Error copying file from %s to %s: %s. Skipping this.....' %(source, destination, err))
             
@@ -305,6 +347,37 @@ class Plugin(object):
             else:
                 self.logger.warn("Failed to set %s permission recursively for %s path!!!" % (visitID,grpPath))
 
+        metrics.COPY_RATE.set(bytesCopied / max(time.time() - start, 0.001), plugin='scarf')
+
+    def process(self, request, datafileIds, journal=None, size=None):
+        '''
+        Deliver one request, releasing the space reserved for it when done
+        '''
+        try:
+            PluginBase.process(self, request, datafileIds, journal, size)
+        finally:
+            if self.capacity is not None:
+                self.capacity.release(request['preparedId'])
+
+    def admit(self):
+        '''
+        Reserve room under the destination for the files still to copy, or raise RequestDeferred
+        '''
+        size = 0
+        for dfId, fileSize in self.df_sizes.iteritems():
+            if self.journal is not None and self.journal.isCopied(dfId):
+                continue
+            size += fileSize or 0
+        reason = self.capacity.admit(self.request['preparedId'], self.destination, size)
+        if reason is not None:
+            raise RequestDeferred(reason)
+
+    def teardown(self):
+        '''
+        Close the LDAP connection when pollcat stops
+        '''
+        self.proxy.disconnect()
+
     def configLdap(self):
         '''
         Configure ldapWrapper authorisation 
@@ -1,53 +1,146 @@
+import ConfigParser
+
+if __name__ == "__main__":
+    config = ConfigParser.ConfigParser()
+    config.read('pollcat.config')
+
+    # the gevent engine has to patch the standard library before anything
+    # below imports socket, ssl or threading
+    if config.get('main', 'ENGINE') == 'gevent':
+        import engines
+        engines.patch()
+
+import sys
 import time
-import requests
 import json
+import signal
 import logging
 import logging.config
-import ConfigParser
-import importlib
+import threading
 
 from common import *
+from workers import Job, WorkerPool, FairQueue, READY, COPYING, COMPLETING
+from httpclient import getClient
+from readiness import ReadinessTracker
+from idcache import DatafileIdCache
+from scheduler import PollScheduler
+from engines import getEngine
+from journal import Journal
+from plugins import loadPlugin, RequestDeferred
+from outbox import CompletionOutbox
+import metrics
+
+def getChunkStatus(ids):
+    """
+    Ask the IDS whether a chunk of datafiles is ONLINE
+
+    Parameters:
+        ids - a comma separated string of datafile ids
+    """
+    response = http.get('ids', '/ids/getStatus',
+        params={'datafileIds' : ids},
+        timeout=float(config.get('main', 'STATUS_TIMEOUT'))
+    )
+    if response.status_code != 200:
+        logger.error("Problem contacting the IDS")
+        return False
+    return response.text == "ONLINE"
+
 
 def checkDatafileStatus(preparedId, datafileIds):
     """
     Check each datafile to see if ONLINE
     Break out on first occurance of non restored file
 
+    Chunks are checked STATUS_CONCURRENCY at a time; once any chunk is
+    found not to be ONLINE no more chunks are requested. With
+    INCREMENTAL_STATUS on, chunks found ONLINE in earlier cycles are skipped
+    until every other chunk is ONLINE, then confirmed once more before the
+    request is reported ready.
+
     Parameters:
         preparedId - an IDS prepared ID (in UUID format)
         datafileIds - a list of integers
     """
-    isready = True
-    for ids in chunks(datafileIds, int(config.get('main', 'STATUS_CHUNKS'))):
-        response = requests.get(
-            url=config.get('main', 'IDS_URL') + '/ids/getStatus',
-            params={'datafileIds' : ids},
-            timeout=15
-        )
-        if response.status_code != 200:
-            logger.error("Problem contacting the IDS")
-            isready = False
-            break
-        if response.text != "ONLINE":
-            isready = False
-            break
-    return isready
+    chunklist = chunks(datafileIds, int(config.get('main', 'STATUS_CHUNKS')))
+    concurrency = int(config.get('main', 'STATUS_CONCURRENCY'))
+
+    if config.getboolean('main', 'INCREMENTAL_STATUS'):
+        pending = readiness.pending(preparedId, len(chunklist))
+    else:
+        pending = range(len(chunklist))
+
+    metrics.STATUS_CHUNKS.observe(len(pending))
+    results = fanout(getChunkStatus, [chunklist[i] for i in pending], concurrency)
+    readiness.markOnline(preparedId, [i for i, online in zip(pending, results) if online])
+    if not all(results):
+        return False
+
+    # final sweep over the chunks only known to be ONLINE from earlier cycles
+    remembered = sorted(set(range(len(chunklist))).difference(pending))
+    if remembered:
+        logger.debug("Confirming %i earlier ONLINE chunks for %s" % (len(remembered), preparedId))
+        results = fanout(getChunkStatus, [chunklist[i] for i in remembered], concurrency)
+        readiness.markOffline(preparedId, [i for i, online in zip(remembered, results) if online is False])
+        if not all(results):
+            return False
+    return True
 
 
 def getDatafileIds(preparedId):
     """
-    Get a list of all datafile ids associated with the preparedId
+    Get a list of all datafile ids associated with the preparedId.
+    The list never changes so it is cached until the request completes.
 
     Parameters:
         preparedId - an IDS prepared ID (in UUID format)
     """
+    datafileIds = datafileIdCache.get(preparedId)
+    if datafileIds is not None:
+        return datafileIds
+
     logger.debug("Retrieving datafileIds for %s" % preparedId)
-    response = requests.get(
-        url=config.get('main', 'IDS_URL') + '/ids/getDatafileIds',
+    response = http.get('ids', '/ids/getDatafileIds',
         timeout=int(config.get('main', 'DATAFILEIDS_TIMEOUT')),
         params={'preparedId' : preparedId}
     )
-    return json.loads(response.text)['ids']
+    datafileIds = json.loads(response.text)['ids']
+    datafileIdCache.put(preparedId, datafileIds)
+    return datafileIds
+
+
+def topcatRequest(method, path, params, **kwargs):
+    """
+    Make a TopCAT admin call with pollcat's ICAT session. If TopCAT rejects
+    the session, e.g. after ICAT has restarted, the call is retried once
+    with a new login, as common.icatSearch does.
+
+    Parameters:
+        method - the HTTP method, e.g. 'GET'
+        path - the path of the endpoint
+        params - the query parameters, without the sessionId
+        kwargs - passed on to the HttpClient
+    """
+    for attempt in range(2):
+        params['sessionId'] = icatclient.getInstance().sessionId
+        response = http.request(method, 'topcat', path,
+            timeout=float(config.get('main', 'TOPCAT_TIMEOUT')),
+            params=params,
+            **kwargs
+        )
+        if attempt or not isSessionError(response):
+            return response
+        logger.warn("TopCAT rejected the ICAT session, logging in again")
+        icatclient.invalidate()
+
+
+def isSessionError(response):
+    """
+    True if TopCAT turned a call away because of its ICAT session
+    """
+    if response.status_code in (401, 403):
+        return True
+    return response.status_code >= 400 and 'SESSION' in response.text.upper()
 
 
 def updateDownloadRequest(preparedId, downloadId):
@@ -61,78 +154,310 @@ def updateDownloadRequest(preparedId, downloadId):
 
     """
     logger.info("Request %s finished, marking as complete" % preparedId)
-    r = requests.put(
-        url=config.get('main', 'TOPCAT_URL') + '/topcat/admin/download/' + str(downloadId) + '/status',
+    r = topcatRequest('PUT', '/topcat/admin/download/' + str(downloadId) + '/status',
         params={
             'icatUrl'   : config.get('main', 'ICAT_URL'), 
-            'sessionId' : icatclient.getInstance().sessionId,
             'value'     : 'COMPLETE'
         },
         headers={"Content-type": "application/x-www-form-urlencoded; charset=UTF-8"}
     )
+    r.raise_for_status()
 
 
-def getDownloadRequests():
+def getDownloadRequestPage(afterId, pageSize):
     """
-    Get a list from TopCAT of all non-complete download requests that
-    match the plugin name
+    Get one page of the non-complete download requests that match the
+    plugin name, in order of download id
+
+    Parameters:
+        afterId - only return requests with a greater download id
+        pageSize - the most requests to return
     """
-    logger.debug("Retrieving Globus download requests from TopCAT")
-    response = requests.get(
-        url=config.get('main', 'TOPCAT_URL') + '/topcat/admin/downloads',
+    response = topcatRequest('GET', '/topcat/admin/downloads',
         params={
             'icatUrl'     : config.get('main', 'ICAT_URL'), 
-            'sessionId'   : icatclient.getInstance().sessionId,
             'queryOffset' : "where download.transport = '" + config.get('main', 'PLUGIN_NAME') + 
                             "' and download.isDeleted = false and download.status = " +
-                            "org.icatproject.topcat.domain.DownloadStatus.RESTORING"
+                            "org.icatproject.topcat.domain.DownloadStatus.RESTORING" +
+                            " and download.id > %i ORDER BY download.id ASC LIMIT 0, %i" % (afterId, pageSize)
         }
     )
-    downloadrequests = json.loads(response.text)
-    logger.debug("Found %s pending requests" % str(len(downloadrequests)))
-    return downloadrequests
+    response.raise_for_status()
+    return json.loads(response.text)
 
 
-def mainloop():
-    for request in getDownloadRequests():
-        datafileIds = getDatafileIds(request['preparedId'])
-        if checkDatafileStatus(request['preparedId'], datafileIds):
-            logger.info("Request %s _IS_ ready" % request['preparedId'])
-            try:
-                logger.debug("Initilising plugin: %s" % config.get('main', 'PLUGIN_NAME'))
-                plugin = plugin_class(request, datafileIds, config, logger)
-                plugin.run()
-                updateDownloadRequest(request['preparedId'], request['id'])
-            except Exception, e:
-                logger.error("%s plugin failed" % config.get('main', 'PLUGIN_NAME'), exc_info=True)
+def getDownloadRequests():
+    """
+    Get all non-complete download requests from TopCAT that match the plugin
+    name, as a generator of pages of DOWNLOADS_PAGE_SIZE requests. The next
+    page is fetched in the background while the caller works on the current
+    one. Pages follow on from the last download id seen rather than an
+    offset, so requests completing during the listing don't shift later
+    pages.
+    """
+    logger.debug("Retrieving Globus download requests from TopCAT")
+    pageSize = int(config.get('main', 'DOWNLOADS_PAGE_SIZE'))
+    found = 0
+    page = getDownloadRequestPage(0, pageSize)
+    while page:
+        found += len(page)
+        nextPage = None
+        if len(page) == pageSize:
+            nextPage = Background(getDownloadRequestPage, page[-1]['id'], pageSize)
+        yield page
+        page = nextPage.result() if nextPage is not None else []
+    logger.debug("Found %s pending requests" % str(found))
+
+
+def processRequest(job):
+    """
+    Run the plugin for a ready request and tell TopCAT it is complete.
+    Called from a worker thread, which logs any failure. Returns False if
+    the plugin deferred the request, which the workers then queue again
+    after DEFER_DELAY seconds.
+
+    Parameters:
+        job - a workers.Job in the COPYING state
+    """
+    # a request journalled as COMPLETING was copied before a restart and
+    # only needs TopCAT telling
+    if journal.state(job.preparedId) != COMPLETING:
+        requestJournal = journal.forRequest(job.preparedId)
+        journal.setState(job.preparedId, COPYING)
+
+        try:
+            getPlugin().process(job.request, job.datafileIds, requestJournal, job.size)
+        except RequestDeferred, e:
+            logger.info("Request %s deferred: %s" % (job.preparedId, e))
+            metrics.DEFERRED_REQUESTS.inc()
+            journal.setState(job.preparedId, READY)
+            return False
+        except:
+            metrics.PLUGIN_FAILURES.inc(plugin=config.get('main', 'PLUGIN_NAME'))
+            raise
+        journal.setState(job.preparedId, COMPLETING)
+
+    job.state = COMPLETING
+    outbox.add(job.preparedId, job.request['id'])
+
+
+def completeRequest(preparedId, downloadId):
+    """
+    Mark a delivered request COMPLETE in TopCAT and forget it. Called by
+    the outbox, which retries until TopCAT accepts the update.
+    """
+    updateDownloadRequest(preparedId, downloadId)
+    journal.finish(preparedId)
+    datafileIdCache.evict(preparedId)
+
+
+def refreshRequests():
+    """
+    Fetch the RESTORING requests from TopCAT, start scheduling any new
+    ones and forget those that have gone. The requests due a check on each
+    page are checked while the next page is being fetched.
+    """
+    preparedIds = []
+    for page in getDownloadRequests():
+        for request in page:
+            preparedIds.append(request['preparedId'])
+            if workers.isActive(request['preparedId']) or outbox.isPending(request['preparedId']):
+                logger.debug("Request %s is already being processed" % request['preparedId'])
                 continue
-        else:
-            logger.info("Request %s _IS_NOT_ ready" % request['preparedId'])
+            if request['preparedId'] not in pending:
+                logger.debug("New request %s" % request['preparedId'])
+            pending[request['preparedId']] = request
+            scheduler.add(request['preparedId'])
+        engine.map(checkDue, scheduler.due())
+
+    for preparedId in set(pending).difference(preparedIds):
+        del pending[preparedId]
+    scheduler.retain(preparedIds)
+    workers.retain(preparedIds)
+    readiness.retain(preparedIds)
+    datafileIdCache.retain(preparedIds)
+    outbox.retain(preparedIds)
+    journal.retain(preparedIds)
+    metrics.PENDING_REQUESTS.set(len(pending))
+
+
+def resumeJobs():
+    """
+    Resubmit the requests the journal shows were in flight when pollcat
+    last stopped
+    """
+    for request, datafileIds, state in journal.entries():
+        if state == COMPLETING:
+            # the outbox picks these up
             continue
+        logger.info("Resuming request %s from state %s" % (request['preparedId'], state))
+        workers.submit(Job(request, datafileIds))
 
 
-if __name__ == "__main__":
-    config = ConfigParser.ConfigParser()
-    config.read('pollcat.config')
+def checkRequest(request):
+    """
+    Hand the request to the workers if all its files are ONLINE, otherwise
+    schedule its next check
+    """
+    preparedId = request['preparedId']
+    datafileIds = getDatafileIds(preparedId)
+    online = readiness.onlineCount(preparedId)
+    if checkDatafileStatus(preparedId, datafileIds):
+        logger.info("Request %s _IS_ ready" % preparedId)
+        readiness.forget(preparedId)
+        scheduler.remove(preparedId)
+        del pending[preparedId]
+        journal.record(request, datafileIds, READY)
+        workers.submit(Job(request, datafileIds))
+    else:
+        logger.info("Request %s _IS_NOT_ ready" % preparedId)
+        scheduler.reschedule(preparedId, readiness.onlineCount(preparedId) > online)
 
-    logging.config.fileConfig('logging.ini')
-    logger = logging.getLogger('root')
 
-    # import plugin class
-    module = importlib.import_module(
-        "plugins." + 
-        config.get('main', 'PLUGIN_NAME') + "." +
-        config.get('main', 'PLUGIN_NAME')
-    )
-    plugin_class = getattr(module, 'Plugin')
+def estimateSize(job):
+    """
+    Return the total size in bytes of a job's datafiles according to ICAT,
+    which the workers use to order requests and the plugin is given. Runs
+    on the workers' sizing thread, off the polling path. Returns None if
+    ICAT can't say.
+    """
+    size = 0
+    try:
+        for ids in chunks(job.datafileIds, int(config.get('main', 'SIZE_CHUNKS'))):
+            total = icatSearch(icatclient, 'SELECT SUM(df.fileSize) FROM Datafile df WHERE df.id IN (%s)' % ids)
+            if total and total[0]:
+                size += int(total[0])
+    except Exception:
+        logger.warn("Unable to estimate the size of request %s" % job.preparedId, exc_info=True)
+        return None
+    return size
+
+
+def mainloop():
+    """
+    List requests from TopCAT every DELAY seconds and check whichever
+    requests are due
+    """
+    global nextListing
+    with metrics.timed(metrics.CYCLE_SECONDS):
+        if time.time() >= nextListing:
+            nextListing = time.time() + float(config.get('main', 'DELAY'))
+            refreshRequests()
+
+        engine.map(checkDue, scheduler.due())
+
+
+def checkDue(preparedId):
+    try:
+        checkRequest(pending[preparedId])
+    except Exception, e:
+        logger.error("Checking request %s failed" % preparedId, exc_info=True)
+        scheduler.reschedule(preparedId, False)
+
+
+def sleepTime():
+    """
+    Seconds until either the next TopCAT listing or the next request check
+    """
+    wakeup = nextListing
+    if scheduler.nextDue() is not None:
+        wakeup = min(wakeup, scheduler.nextDue())
+    return max(wakeup - time.time(), 0.1)
+
+
+def getPlugin():
+    """
+    Load and set up the plugin on first use, so that start up doesn't wait
+    for the plugin's own imports and connections (e.g. LDAP for scarf)
+    """
+    global plugin
+    with pluginLock:
+        if plugin is None:
+            logger.debug("Initilising plugin: %s" % config.get('main', 'PLUGIN_NAME'))
+            plugin = loadPlugin(config.get('main', 'PLUGIN_NAME'), config, logger)
+        return plugin
+
+
+def setup(mainConfig, mainLogger):
+    """
+    Create the state shared by the main loop and the workers and resume
+    any journalled requests. Called once at start up, and by the
+    benchmarks in bench/.
+
+    Parameters:
+        mainConfig - a ConfigParser holding pollcat.config
+        mainLogger - the logger for pollcat and its plugin
+    """
+    global config, logger, plugin, pluginLock, icatclient, http, readiness, datafileIdCache
+    global engine, journal, workers, outbox, scheduler, pending, nextListing
+
+    config = mainConfig
+    logger = mainLogger
+
+    plugin = None     # loaded by getPlugin() when first needed
+    pluginLock = threading.Lock()
 
     icatclient = IcatClient(config)
+    http = getClient(config)
+    readiness = ReadinessTracker()
+    datafileIdCache = DatafileIdCache(
+        int(config.get('main', 'DATAFILEIDS_CACHE_SIZE')),
+        config.get('main', 'DATAFILEIDS_CACHE_DIR') or None
+    )
 
-    while True:
-        try:
-            mainloop()
-        except Exception as e:
-            logger.error("Mainloop has unexpectedly stopped", exc_info=True)
+    scheduler = PollScheduler(
+        float(config.get('main', 'DELAY')),
+        float(config.get('main', 'MAX_DELAY')),
+        float(config.get('main', 'BACKOFF'))
+    )
+    pending = {}    #preparedId:request waiting for its files to be ONLINE
+    nextListing = 0
+
+    engine = getEngine(config, logger)
+    journal = Journal(config.get('main', 'JOURNAL'))
+    workers = WorkerPool(
+        int(config.get('main', 'WORKERS')),
+        processRequest,
+        FairQueue(
+            int(config.get('main', 'LARGE_REQUEST_FILES')),
+            int(config.get('main', 'LARGE_REQUEST_BYTES')),
+            int(config.get('main', 'LARGE_WORKERS'))
+        ),
+        logger,
+        estimateSize if config.getboolean('main', 'ESTIMATE_SIZES') else None,
+        int(config.get('main', 'SIZE_THREADS')),
+        float(config.get('main', 'DEFER_DELAY'))
+    )
+    outbox = CompletionOutbox(
+        journal,
+        completeRequest,
+        int(config.get('main', 'OUTBOX_CONCURRENCY')),
+        float(config.get('main', 'OUTBOX_RETRY_DELAY')),
+        float(config.get('main', 'OUTBOX_MAX_DELAY')),
+        logger
+    )
+    resumeJobs()
 
-        time.sleep(float(config.get('main', 'DELAY')))
+    if int(config.get('main', 'METRICS_PORT')):
+        metrics.serve(int(config.get('main', 'METRICS_PORT')))
+    if config.get('main', 'METRICS_FILE'):
+        metrics.dump(config.get('main', 'METRICS_FILE'), float(config.get('main', 'METRICS_INTERVAL')), logger)
+
+
+if __name__ == "__main__":
+    logging.config.fileConfig('logging.ini')
+    setup(config, logging.getLogger('root'))
+
+    # pollcatd stops us with SIGTERM, let the plugin tear down first
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            try:
+                mainloop()
+            except Exception as e:
+                logger.error("Mainloop has unexpectedly stopped", exc_info=True)
 
+            time.sleep(sleepTime())
+    finally:
+        if plugin is not None:
+            plugin.teardown()
@@ -0,0 +1,65 @@
+import threading
+
+"""
+Incremental readiness tracking for PollCAT
+
+Files restored from tape stay ONLINE for a long time, so there is no need
+to ask the IDS about them again every cycle. The tracker remembers, for
+each preparedId, which STATUS_CHUNKS chunks of its datafileIds have been
+reported ONLINE so that later cycles only query the chunks still
+outstanding.
+"""
+
+class ReadinessTracker(object):
+    """
+    Remembers which chunks of each request have been reported ONLINE
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.online = {}    #preparedId:set(chunk index)
+
+
+    def pending(self, preparedId, count):
+        """
+        Return the indexes of the chunks not yet known to be ONLINE
+
+        Parameters:
+            preparedId - an IDS prepared ID (in UUID format)
+            count - the number of chunks the request is split into
+        """
+        with self.lock:
+            online = self.online.get(preparedId, set())
+            return [i for i in range(count) if i not in online]
+
+
+    def onlineCount(self, preparedId):
+        with self.lock:
+            return len(self.online.get(preparedId, ()))
+
+
+    def markOnline(self, preparedId, indexes):
+        with self.lock:
+            self.online.setdefault(preparedId, set()).update(indexes)
+
+
+    def markOffline(self, preparedId, indexes):
+        with self.lock:
+            self.online.get(preparedId, set()).difference_update(indexes)
+
+
+    def forget(self, preparedId):
+        with self.lock:
+            self.online.pop(preparedId, None)
+
+
+    def retain(self, preparedIds):
+        """
+        Forget every request not in preparedIds
+
+        Parameters:
+            preparedIds - the preparedIds from the latest TopCAT listing
+        """
+        with self.lock:
+            for preparedId in set(self.online).difference(preparedIds):
+                del self.online[preparedId]
@@ -0,0 +1,111 @@
+import time
+import heapq
+import threading
+
+"""
+Adaptive poll scheduler for PollCAT
+
+Rather than checking every request every DELAY seconds, each request has
+its own next check time held in a priority queue. A request that stays
+RESTORING is checked less and less often, up to a maximum delay, while
+one that shows progress (more chunks ONLINE) or has just appeared in
+TopCAT is checked again straight away or after the minimum delay.
+"""
+
+class PollScheduler(object):
+    """
+    Priority queue of preparedIds keyed on when each is next due a check
+    """
+
+    def __init__(self, minDelay, maxDelay, backoff):
+        """
+        Parameters:
+            minDelay - seconds between checks of a request showing progress
+            maxDelay - the most seconds to leave a request unchecked
+            backoff - factor to grow the delay by after a check with no progress
+        """
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.heap = []      #(due, preparedId), may hold stale entries
+        self.entries = {}   #preparedId:(due, delay)
+
+
+    def add(self, preparedId, now=None):
+        """
+        Start tracking a request, due immediately. Known requests are left
+        as they are.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if preparedId not in self.entries:
+                self.push(preparedId, now, self.minDelay)
+
+
+    def push(self, preparedId, due, delay):
+        self.entries[preparedId] = (due, delay)
+        heapq.heappush(self.heap, (due, preparedId))
+
+
+    def due(self, now=None):
+        """
+        Remove and return the preparedIds due a check, earliest first.
+        Each one must be handed back with reschedule() or remove().
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                when, preparedId = heapq.heappop(self.heap)
+                if self.entries.get(preparedId, (None,))[0] == when:
+                    due.append(preparedId)
+        return due
+
+
+    def reschedule(self, preparedId, progressed, now=None):
+        """
+        Schedule the next check of a request that is not ready yet
+
+        Parameters:
+            preparedId - an IDS prepared ID (in UUID format)
+            progressed - True if the last check found more files ONLINE
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if preparedId not in self.entries:
+                return
+            if progressed:
+                delay = self.minDelay
+            else:
+                delay = min(self.entries[preparedId][1] * self.backoff, self.maxDelay)
+            self.push(preparedId, now + delay, delay)
+
+
+    def remove(self, preparedId):
+        with self.lock:
+            self.entries.pop(preparedId, None)
+
+
+    def retain(self, preparedIds):
+        """
+        Stop tracking every request not in preparedIds
+        """
+        with self.lock:
+            for preparedId in set(self.entries).difference(preparedIds):
+                del self.entries[preparedId]
+
+
+    def nextDue(self):
+        """
+        Return the time the next request is due a check, or None
+        """
+        with self.lock:
+            while self.heap and self.entries.get(self.heap[0][1], (None,))[0] != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if self.heap:
+                return self.heap[0][0]
+            return None
@@ -0,0 +1,136 @@
+import os
+import re
+import stat
+import time
+import threading
+
+import metrics
+from transfer import hardlink
+
+"""
+Shared datafile store for PollCAT plugins
+
+Popular datafiles are requested by many users. Rather than writing a new
+copy into every download, each datafile is copied once into the store and
+hardlinked into every download that asks for it, so later requests cost a
+link rather than a copy and the destination holds one copy of the data.
+The store must be on the same filesystem as the downloads.
+
+A store entry is named after its ICAT datafile id, checksum and size, so
+a datafile that changes in ICAT gets a new entry. Entries are made read
+only, as every user given one shares its inode. The links are the
+reference count: an entry whose only link is the store's own (st_nlink of
+1) is no longer in any download and collect() removes it, along with
+any partly copied entry left by a crash.
+"""
+
+# entries are spread over this many locks, so that two requests for the
+# same datafile don't both copy it and collect() can't remove an entry
+# while it is being linked
+LOCKS = 64
+
+def device(path):
+    """
+    Return the st_dev of path, or of its nearest existing parent
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+class SharedStore(object):
+    """
+    Content addressed store of datafiles, linked into users' downloads
+    """
+
+    def __init__(self, root, copier, collectInterval, logger):
+        """
+        Parameters:
+            root - the store directory, on the same filesystem as the
+                   downloads
+            copier - the transfer.Copier entries are filled with
+            collectInterval - the least seconds between calls to collect()
+                              made by maybeCollect()
+        """
+        self.root = root
+        self.copier = copier
+        self.collectInterval = collectInterval
+        self.logger = logger
+        self.locks = [threading.Lock() for i in range(LOCKS)]
+        self.collectLock = threading.Lock()
+        self.lastCollect = time.time()
+
+        if not os.path.isdir(root):
+            os.makedirs(root, 0700)
+
+
+    def entry(self, datafile, source):
+        """
+        Return the store path for a datafile
+        """
+        size = datafile.fileSize if datafile.fileSize is not None else os.path.getsize(source)
+        checksum = re.sub('\W', '', datafile.checksum or '') or 'none'
+        return os.path.join(self.root, '%02x' % (datafile.id % 256), '%i-%s-%i' % (datafile.id, checksum, size))
+
+
+    def lock(self, path):
+        return self.locks[hash(path) % LOCKS]
+
+
+    def copy(self, datafile, source, destination):
+        """
+        Link the datafile's store entry to destination, copying it from
+        source into the store first if it isn't there yet
+        """
+        entry = self.entry(datafile, source)
+        with self.lock(entry):
+            if os.path.exists(entry):
+                metrics.STORE_HITS.inc()
+            else:
+                if not os.path.isdir(os.path.dirname(entry)):
+                    os.makedirs(os.path.dirname(entry))
+                temp = entry + '.tmp'
+                self.copier.copy(source, temp, datafile.checksum)
+                os.chmod(temp, stat.S_IMODE(os.stat(temp).st_mode) & ~0222)
+                os.rename(temp, entry)
+            hardlink(entry, destination)
+
+
+    def collect(self):
+        """
+        Remove the entries no download links to any more, and partly
+        copied entries, returning how many were removed
+        """
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                partial = name.endswith('.tmp')
+                with self.lock(path[:-len('.tmp')] if partial else path):
+                    try:
+                        # an entry is copied and renamed into place under
+                        # its lock, so a .tmp seen here was left by a crash
+                        if partial or os.stat(path).st_nlink == 1:
+                            os.unlink(path)
+                            removed += 1
+                    except OSError, err:
+                        self.logger.warn("Unable to remove store entry %s: %s" % (path, err))
+        return removed
+
+
+    def maybeCollect(self):
+        """
+        Run collect() if it hasn't run for collectInterval seconds, unless
+        another thread is already running it
+        """
+        if time.time() - self.lastCollect < self.collectInterval:
+            return
+        if not self.collectLock.acquire(False):
+            return
+        try:
+            self.lastCollect = time.time()
+            removed = self.collect()
+            self.logger.info("Removed %i unused entries from the store in %s" % (removed, self.root))
+        finally:
+            self.collectLock.release()
@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+import ConfigParser
+
+import metrics
+
+"""
+I/O governor for PollCAT plugin copies
+
+Copies read from the same filesystem the IDS restores to, so left alone
+they can slow down the very restores pollcat is waiting for. The Governor
+holds token buckets limiting the bytes and file operations per second the
+copies make, across all source filesystems and for each one. Copies ask
+for tokens before each file and each chunk they read, and wait if the
+buckets are empty.
+
+The limits live in THROTTLE_FILE, which is read again whenever it
+changes, so they can be adjusted without restarting pollcat:
+
+    [global]
+    BANDWIDTH: 500000000    # bytes per second, 0 for no limit
+    IOPS: 2000              # files opened plus chunks read per second
+
+    [/data/ids/datafiles]   # any path on a source filesystem
+    BANDWIDTH: 200000000
+    IOPS: 0
+"""
+
+# seconds between checks for a changed THROTTLE_FILE
+RELOAD_INTERVAL = 5
+
+_governor = None
+_governorLock = threading.Lock()
+
+
+def getGovernor(config, logger):
+    """
+    Return the process wide Governor, creating it on first use, or None if
+    THROTTLE_FILE isn't set
+    """
+    global _governor
+    with _governorLock:
+        if _governor is None and config.get('main', 'THROTTLE_FILE'):
+            _governor = Governor(config.get('main', 'THROTTLE_FILE'), logger)
+        return _governor
+
+
+class TokenBucket(object):
+    """
+    Allows rate tokens a second, with up to a second's worth saved up
+    """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+
+    def reserve(self, amount):
+        """
+        Take amount tokens, going into debt if there aren't enough, and
+        return the seconds to wait before using them
+        """
+        with self.lock:
+            if not self.rate or not amount:
+                return 0
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate) - amount
+            self.last = now
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class Governor(object):
+    """
+    Bandwidth and IOPS limits for copies, overall and per source filesystem
+    """
+
+    def __init__(self, path, logger):
+        """
+        Parameters:
+            path - the THROTTLE_FILE holding the limits
+        """
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.buckets = {}   #None for the global limits or st_dev:(bandwidth TokenBucket, IOPS TokenBucket)
+        self.mtime = None
+        self.nextReload = 0
+        self.reload()
+
+
+    def reload(self):
+        """
+        Read the limits again if THROTTLE_FILE has changed
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        parser = ConfigParser.ConfigParser()
+        parser.read(self.path)
+        limits = {}
+        for section in parser.sections():
+            try:
+                device = None if section == 'global' else os.stat(section).st_dev
+                limits[device] = (int(parser.get(section, 'BANDWIDTH')), int(parser.get(section, 'IOPS')))
+            except (OSError, ValueError, ConfigParser.Error), err:
+                self.logger.warn("Ignoring throttle limits for %s: %s" % (section, err))
+                continue
+            self.logger.info("Throttling copies from %s to %i bytes/s and %i IOPS (0 is unlimited)" % (
+                section, limits[device][0], limits[device][1]))
+
+        with self.lock:
+            for device in set(self.buckets).union(limits):
+                bandwidth, iops = limits.get(device, (0, 0))
+                if device not in self.buckets:
+                    self.buckets[device] = (TokenBucket(), TokenBucket())
+                self.buckets[device][0].setRate(bandwidth)
+                self.buckets[device][1].setRate(iops)
+
+
+    def take(self, device, size=0, ops=0):
+        """
+        Wait until a copy may read size bytes with ops operations from the
+        filesystem with st_dev device
+        """
+        now = time.time()
+        if now >= self.nextReload:
+            self.nextReload = now + RELOAD_INTERVAL
+            self.reload()
+
+        wait = 0
+        with self.lock:
+            buckets = [self.buckets.get(None), self.buckets.get(device)]
+        for bucket in buckets:
+            if bucket is not None:
+                wait = max(wait, bucket[0].reserve(size), bucket[1].reserve(ops))
+        if wait > 0:
+            metrics.THROTTLE_SECONDS.inc(wait)
+            time.sleep(wait)
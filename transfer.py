@@ -0,0 +1,498 @@
+import os
+import time
+import errno
+import zlib
+import fcntl
+import hashlib
+import shutil
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+import metrics
+
+"""
+Copy engine for PollCAT plugins
+
+A fixed pool of threads that copies files concurrently for every request
+a plugin is delivering, so a request of many small files keeps the
+filesystems and cores busy instead of copying one file at a time. The
+number of copies running against any one filesystem (source or
+destination, told apart by st_dev) is capped separately from the size of
+the pool, so a slow filesystem can't take every thread.
+
+Files are added to a Batch as they become known and the batch is waited
+on at the end:
+
+    batch = engine.batch(onCopied=lambda key, size: ...)
+    batch.add(datafile.id, source, destination)
+    result = batch.wait()
+
+A failed file is logged and recorded in result.failed, and the rest of
+the batch carries on.
+
+How each file is copied is up to a Copier, which tries a list of
+strategies in order and falls back to the next when one isn't supported
+between two filesystems:
+
+    reflink         - clone the file's extents (FICLONE), e.g. on XFS,
+                      btrfs or some NFS servers; no data is copied at all
+    copy_file_range - copy inside the kernel, offloaded to the server on
+                      NFS 4.2 and some parallel filesystems
+    sendfile        - copy inside the kernel
+    hardlink        - link the destination to the source, when both are on
+                      the same filesystem. The download then shares its
+                      inode with the archive, so only use it when users
+                      can't write to or chown what they are given
+    copy            - buffered copy through python, always tried last
+
+A Copier can also verify each file against the checksum ICAT holds for
+it. The data is checksummed as it is copied, which needs the buffered
+copy, and a file that doesn't match is copied again up to a set number
+of times before ChecksumError is raised.
+
+Given a throttle.Governor, a Copier asks it for tokens for every file it
+opens and every chunk it reads, per source filesystem.
+"""
+
+STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'hardlink', 'copy')
+
+# errors meaning a strategy can't be used between two filesystems, rather
+# than that the copy itself failed
+UNSUPPORTED = set([errno.EXDEV, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+                   errno.ENOSYS, errno.EINVAL, errno.ENOTTY, errno.EPERM, errno.EBADF])
+
+FICLONE = 0x40049409    # _IOW(0x94, 9, int) from linux/fs.h
+
+# bytes moved by each copy_file_range or sendfile call, small enough for
+# the throttle to keep the rate smooth
+KERNEL_CHUNK = 16 << 20
+
+# bytes read at a time when checksumming
+READ_CHUNK = 1 << 20
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+
+_sendfile = getattr(_libc, 'sendfile', None)
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+
+def unthrottled(size, ops=1):
+    pass
+
+
+def kernelCopy(call, source, destination, throttle):
+    """
+    Copy source to destination with call(in fd, out fd, count), which
+    returns the bytes moved like copy_file_range and sendfile do
+    """
+    if call is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    with open(source, 'rb') as src:
+        remaining = os.fstat(src.fileno()).st_size
+        with open(destination, 'wb') as dst:
+            while remaining > 0:
+                throttle(min(remaining, KERNEL_CHUNK))
+                n = call(src.fileno(), dst.fileno(), min(remaining, KERNEL_CHUNK))
+                if n < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+                if n == 0:
+                    break
+                remaining -= n
+
+
+def reflink(source, destination, throttle):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copyFileRange(source, destination, throttle):
+    kernelCopy(_copy_file_range and (lambda i, o, n: _copy_file_range(i, None, o, None, n, 0)),
+               source, destination, throttle)
+
+
+def sendfile(source, destination, throttle):
+    kernelCopy(_sendfile and (lambda i, o, n: _sendfile(o, i, None, n)), source, destination, throttle)
+
+
+def bufferedCopy(source, destination, throttle):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            while True:
+                block = src.read(READ_CHUNK)
+                if not block:
+                    break
+                throttle(len(block))
+                dst.write(block)
+
+
+def hardlink(source, destination, throttle=unthrottled):
+    # link beside the destination then rename, so an existing file is
+    # replaced in one step
+    temp = destination + '.pollcat-link'
+    if os.path.lexists(temp):
+        os.unlink(temp)
+    os.link(source, temp)
+    os.rename(temp, destination)
+
+
+class Crc(object):
+    """
+    Gives zlib's crc32 and adler32 the update()/hexdigest() of hashlib
+    """
+
+    def __init__(self, func, start):
+        self.func = func
+        self.value = start
+
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+
+# the IDS records a CRC32 for every datafile
+CHECKSUMS = {
+    'crc32'   : lambda: Crc(zlib.crc32, 0),
+    'adler32' : lambda: Crc(zlib.adler32, 1),
+    'md5'     : hashlib.md5,
+    'sha1'    : hashlib.sha1,
+    'sha256'  : hashlib.sha256
+}
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def checksumFile(path, algorithm='crc32'):
+    """
+    Return the checksum of a file as a hex string
+    """
+    digest = CHECKSUMS[algorithm]()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_CHUNK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksumMatches(expected, actual):
+    """
+    Compare a checksum from ICAT, which may be upper case or have lost its
+    leading zeros, with one from checksumFile()
+    """
+    return expected.strip().lower().zfill(len(actual)) == actual
+
+
+def verifiedCopy(source, destination, algorithm, throttle=unthrottled):
+    """
+    Buffered copy which checksums the data as it is copied, so verifying
+    a file costs no extra read. Returns the checksum.
+    """
+    digest = CHECKSUMS[algorithm]()
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            while True:
+                block = src.read(READ_CHUNK)
+                if not block:
+                    break
+                throttle(len(block))
+                digest.update(block)
+                dst.write(block)
+    return digest.hexdigest()
+
+
+def isIdentical(source, destination, checksum=None, algorithm='crc32'):
+    """
+    True if destination already holds a copy of source: the same size and
+    modification time (to the second, as not every filesystem keeps more)
+    and, if checksum is given, a matching checksum
+    """
+    try:
+        dst = os.stat(destination)
+    except OSError:
+        return False
+    src = os.stat(source)
+    if dst.st_size != src.st_size or int(dst.st_mtime) != int(src.st_mtime):
+        return False
+    return checksum is None or checksumMatches(checksum, checksumFile(destination, algorithm))
+
+
+COPIERS = {
+    'reflink'         : reflink,
+    'copy_file_range' : copyFileRange,
+    'sendfile'        : sendfile,
+    'hardlink'        : hardlink,
+    'copy'            : bufferedCopy
+}
+
+
+class Copier(object):
+    """
+    Copies one file at a time with the first strategy that works
+    """
+
+    def __init__(self, strategies, logger, algorithm=None, retries=0, governor=None):
+        """
+        Parameters:
+            strategies - a comma separated list of names from STRATEGIES,
+                         in the order to try them. The buffered copy is
+                         always tried last.
+            algorithm - a name from CHECKSUMS to verify copies with, or
+                        None not to verify them
+            retries - the number of times to copy a file again when it
+                      doesn't match its checksum
+            governor - the throttle.Governor limiting the copies, if any
+        """
+        if algorithm and algorithm not in CHECKSUMS:
+            raise ValueError("Unknown checksum algorithm: %s" % algorithm)
+        self.strategies = [name.strip() for name in strategies.split(',') if name.strip()]
+        for name in self.strategies:
+            if name not in STRATEGIES:
+                raise ValueError("Unknown copy strategy: %s" % name)
+        if 'copy' in self.strategies:
+            self.strategies.remove('copy')
+        self.strategies.append('copy')
+        self.algorithm = algorithm or None
+        self.retries = retries
+        self.governor = governor
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.unsupported = set()    #(strategy, source st_dev, destination st_dev)
+
+
+    def copy(self, source, destination, checksum=None):
+        """
+        Copy source to destination, with its permissions and times,
+        replacing any existing file. If the Copier verifies copies and
+        checksum is given, the copy is checked against it. Returns the name
+        of the strategy used.
+        """
+        if os.path.exists(destination) and os.stat(destination).st_nlink > 1:
+            # don't write through a hardlink into the source
+            os.unlink(destination)
+
+        devices = (os.stat(source).st_dev, os.stat(os.path.dirname(destination)).st_dev)
+        throttle = unthrottled
+        if self.governor is not None:
+            throttle = lambda size, ops=1: self.governor.take(devices[0], size, ops)
+        # opening the file
+        throttle(0)
+
+        if self.algorithm is not None and checksum:
+            self.verify(source, destination, checksum, throttle)
+            shutil.copystat(source, destination)
+            return 'copy'
+
+        for name in self.strategies:
+            if (name,) + devices in self.unsupported:
+                continue
+            try:
+                COPIERS[name](source, destination, throttle)
+            except EnvironmentError, e:
+                if name == 'copy' or e.errno not in UNSUPPORTED:
+                    raise
+                self.logger.info("Unable to %s from %s to %s (%s), falling back" % (
+                    name, os.path.dirname(source), os.path.dirname(destination), e))
+                with self.lock:
+                    self.unsupported.add((name,) + devices)
+                continue
+            if name != 'hardlink':
+                # keep the source's mtime, so isIdentical() can tell
+                # the copy is current
+                shutil.copystat(source, destination)
+            return name
+
+
+    def verify(self, source, destination, checksum, throttle):
+        for attempt in range(1, self.retries + 2):
+            actual = verifiedCopy(source, destination, self.algorithm, throttle)
+            if checksumMatches(checksum, actual):
+                return
+            metrics.CHECKSUM_MISMATCHES.inc()
+            self.logger.warn("%s checksum of %s is %s, not %s as ICAT records (attempt %i of %i)" % (
+                self.algorithm, source, actual, checksum, attempt, self.retries + 1))
+
+        # don't leave a bad copy to be delivered or mistaken for a good one
+        os.unlink(destination)
+        raise ChecksumError("%s does not match its checksum %s" % (source, checksum))
+
+class CopyResult(object):
+    """
+    Totals for a finished batch
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0    #files already in place
+        self.seconds = 0.0
+        self.failed = {}    #key:exception
+
+
+    def rate(self):
+        """
+        Bytes copied per second
+        """
+        return self.bytes / max(self.seconds, 0.001)
+
+
+class Batch(object):
+    """
+    The files copied for one request
+    """
+
+    def __init__(self, engine, onCopied=None, copy=None, limit=None):
+        self.engine = engine
+        self.onCopied = onCopied
+        self.copy = copy or (lambda key, source, destination: engine.copier.copy(source, destination))
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.outstanding = 0
+        self.finished = threading.Event()
+        self.finished.set()
+        self.result = CopyResult()
+        self.start = time.time()
+
+
+    def add(self, key, source, destination):
+        """
+        Queue source to be copied to destination. key identifies the file
+        in the result and to onCopied(key, size). Waits while the batch
+        already has limit files waiting or being copied.
+        """
+        with self.lock:
+            while self.limit and self.outstanding >= self.limit:
+                self.space.wait()
+            self.outstanding += 1
+            self.finished.clear()
+        self.engine.queue.put((self, key, source, destination))
+
+
+    def done(self, key, size=None, error=None, skipped=False):
+        with self.lock:
+            if error is not None:
+                self.result.failed[key] = error
+            elif skipped:
+                self.result.skipped += 1
+            else:
+                self.result.files += 1
+                self.result.bytes += size
+            self.outstanding -= 1
+            self.space.notify()
+            if self.outstanding == 0:
+                self.finished.set()
+
+
+    def wait(self):
+        """
+        Wait for every file added so far and return the CopyResult
+        """
+        self.finished.wait()
+        self.result.seconds = time.time() - self.start
+        return self.result
+
+
+class CopyEngine(object):
+    """
+    Pool of copy threads shared by every request a plugin delivers
+    """
+
+    def __init__(self, threads, fsConcurrency, copier, logger):
+        """
+        Parameters:
+            threads - the number of files to copy at once
+            fsConcurrency - the most copies running against one filesystem
+            copier - the Copier each file is copied with
+        """
+        self.fsConcurrency = fsConcurrency
+        self.copier = copier
+        self.logger = logger
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.limits = {}    #st_dev:Semaphore
+
+        for i in range(threads):
+            copier = threading.Thread(target=self.work, name="copy-%i" % i)
+            copier.daemon = True
+            copier.start()
+
+
+    def batch(self, onCopied=None, copy=None, limit=None):
+        """
+        Start a new batch. onCopied(key, size) is called from a copy thread
+        as each file finishes copying. copy(key, source, destination), if
+        given, copies each file instead of the engine's Copier, returning
+        False if it found the file already in place. limit, if given, is
+        the most files the batch queues at once, so that one large request
+        doesn't queue all its files ahead of every other request's.
+        """
+        return Batch(self, onCopied, copy, limit)
+
+
+    def limit(self, device):
+        with self.lock:
+            if device not in self.limits:
+                self.limits[device] = threading.Semaphore(self.fsConcurrency)
+            return self.limits[device]
+
+
+    def copyfile(self, batch, key, source, destination):
+        """
+        Copy one file for a batch, creating its directory. Returns its size
+        and whether it was copied.
+        """
+        destination_dir = os.path.dirname(destination)
+        if not os.path.isdir(destination_dir):
+            try:
+                os.makedirs(destination_dir)
+            except OSError:
+                # another thread may have just made it
+                if not os.path.isdir(destination_dir):
+                    raise
+
+        # always take the limits in the same order so copies between the
+        # same two filesystems can't deadlock
+        devices = sorted(set([os.stat(source).st_dev, os.stat(destination_dir).st_dev]))
+        limits = [self.limit(device) for device in devices]
+        for limit in limits:
+            limit.acquire()
+        try:
+            copied = batch.copy(key, source, destination) is not False
+        finally:
+            for limit in reversed(limits):
+                limit.release()
+        return os.path.getsize(destination), copied
+
+
+    def work(self):
+        while True:
+            batch, key, source, destination = self.queue.get()
+            try:
+                size, copied = self.copyfile(batch, key, source, destination)
+                if copied and batch.onCopied is not None:
+                    batch.onCopied(key, size)
+            except Exception, e:
+                self.logger.error("Unable to copy %s -> %s: %s" % (source, destination, e))
+                batch.done(key, error=e)
+            else:
+                batch.done(key, size, skipped=not copied)
+
@@ -0,0 +1,279 @@
+import time
+import Queue
+import heapq
+import threading
+
+"""
+Worker pool for PollCAT
+
+Each TopCAT download request that is ready to be delivered becomes a Job
+which is handed to a pool of worker threads. The main loop carries on
+polling TopCAT and the IDS while the workers run the plugin, so one large
+request no longer holds up every other request.
+
+A job moves through the states:
+
+    PENDING -> READY -> COPYING -> COMPLETING
+
+and is forgotten once it has finished (successfully or not). A job the
+plugin defers goes back to READY and is queued again after a delay,
+keeping its size, without the main loop checking its files again.
+
+A job whose size isn't known yet is first sized by the pool's estimator
+on sizing threads of its own, so that the main loop never waits for it.
+Jobs with the fewest files are sized first, and jobs with the FairQueue's
+large number of files have their own sizing threads, so a small request
+is never held up behind a huge one being summed. Ready jobs then wait in a
+FairQueue rather than being taken in the order they became ready. The users with jobs waiting take turns, each user's
+smallest job going first, so that one user's huge request doesn't hold
+up everyone else's small ones. Large jobs are also limited to a share of
+the workers, leaving the rest free for the small ones.
+"""
+
+PENDING = 'PENDING'
+READY = 'READY'
+COPYING = 'COPYING'
+COMPLETING = 'COMPLETING'
+
+
+class Job(object):
+    """
+    A single TopCAT download request and its progress through pollcat
+    """
+
+    def __init__(self, request, datafileIds, size=None):
+        """
+        Parameters:
+            request - the TopCAT download request
+            datafileIds - the request's datafile ids
+            size - the request's estimated size in bytes, if known
+        """
+        self.request = request
+        self.preparedId = request['preparedId']
+        self.user = request.get('userName')
+        self.datafileIds = datafileIds
+        self.size = size
+        self.state = PENDING
+
+
+    def order(self):
+        # unknown sizes go after the known ones
+        return (self.size is None, self.size or 0, len(self.datafileIds))
+
+
+class FairQueue(object):
+    """
+    Ready jobs, handed out a user at a time in turn, smallest first, with
+    at most largeSlots large jobs out at once
+    """
+
+    def __init__(self, largeFiles, largeBytes, largeSlots):
+        """
+        Parameters:
+            largeFiles - jobs with at least this many files are large
+            largeBytes - jobs of at least this many bytes are large
+            largeSlots - the most large jobs to hand out at once
+        """
+        self.largeFiles = largeFiles
+        self.largeBytes = largeBytes
+        self.largeSlots = largeSlots
+        self.lock = threading.Condition()
+        self.users = {}     #user:heap of (order, count, Job)
+        self.turns = []     #users with jobs waiting, in turn order
+        self.count = 0
+        self.large = 0      #large jobs handed out and not yet done
+
+
+    def isLarge(self, job):
+        return len(job.datafileIds) >= self.largeFiles or (job.size is not None and job.size >= self.largeBytes)
+
+
+    def put(self, job):
+        with self.lock:
+            self.count += 1
+            if job.user not in self.users:
+                self.users[job.user] = []
+                self.turns.append(job.user)
+            heapq.heappush(self.users[job.user], (job.order(), self.count, job))
+            self.lock.notify()
+
+
+    def get(self):
+        """
+        Wait for and return the next job
+        """
+        with self.lock:
+            while True:
+                for user in self.turns:
+                    jobs = self.users[user]
+                    job = jobs[0][2]
+                    if self.isLarge(job):
+                        if self.large >= self.largeSlots:
+                            # look for a small job instead
+                            continue
+                        self.large += 1
+                    heapq.heappop(jobs)
+                    # to the back of the line
+                    self.turns.remove(user)
+                    if jobs:
+                        self.turns.append(user)
+                    else:
+                        del self.users[user]
+                    return job
+                self.lock.wait()
+
+
+    def done(self, job):
+        """
+        Return the slot held by a job from get() once it has finished
+        """
+        with self.lock:
+            if self.isLarge(job):
+                self.large -= 1
+                self.lock.notify()
+
+
+class WorkerPool(object):
+    """
+    Fixed size pool of threads which run handler(job) for each submitted
+    job. A request is only ever held by one job at a time, so the main loop
+    can ask isActive() before picking a request up again. A handler that
+    returns False has deferred the job, which is queued again deferDelay
+    seconds later.
+    """
+
+    def __init__(self, size, handler, queue, logger, estimator=None, sizers=1, deferDelay=0):
+        """
+        Parameters:
+            size - the number of worker threads
+            handler - function(job) delivering a job
+            queue - the FairQueue ready jobs wait in
+            estimator - function(job) returning the size in bytes of a job
+                        submitted without one, or None
+            sizers - the number of threads running the estimator, for
+                     each of small and large jobs
+            deferDelay - seconds before a deferred job is queued again
+        """
+        self.handler = handler
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.later = threading.Condition(self.lock)
+        self.queue = queue
+        self.estimator = estimator
+        self.deferDelay = deferDelay
+        self.unsized = Queue.PriorityQueue()       #(files, count, Job) to size
+        self.unsizedLarge = Queue.PriorityQueue()  #the same, for jobs with largeFiles files
+        self.deferred = []      #heap of (time, count, Job) to queue again
+        self.count = 0
+        self.jobs = {}          #preparedId:Job, being sized, queued, deferred or running
+        self.finished = set()   #preparedIds finished but maybe still listed by TopCAT
+
+        requeuer = threading.Thread(target=self.requeue, name="requeuer")
+        requeuer.daemon = True
+        requeuer.start()
+
+        for i in range(size):
+            worker = threading.Thread(target=self.work, name="worker-%i" % i)
+            worker.daemon = True
+            worker.start()
+
+        if estimator is not None:
+            for unsized, name in [(self.unsized, "sizer"), (self.unsizedLarge, "large-sizer")]:
+                for i in range(sizers):
+                    sizer = threading.Thread(target=self.size, args=(unsized,), name="%s-%i" % (name, i))
+                    sizer.daemon = True
+                    sizer.start()
+
+
+    def isActive(self, preparedId):
+        """
+        True if the request is queued, being copied or has just finished
+        """
+        with self.lock:
+            return preparedId in self.jobs or preparedId in self.finished
+
+
+    def submit(self, job):
+        """
+        Queue a READY job. Returns False if the request is already active.
+        """
+        with self.lock:
+            if job.preparedId in self.jobs or job.preparedId in self.finished:
+                return False
+            job.state = READY
+            self.jobs[job.preparedId] = job
+            self.count += 1
+            count = self.count
+        if self.estimator is not None and job.size is None:
+            if self.queue.isLarge(job):
+                self.unsizedLarge.put((len(job.datafileIds), count, job))
+            else:
+                self.unsized.put((len(job.datafileIds), count, job))
+        else:
+            self.queue.put(job)
+        return True
+
+
+    def retain(self, preparedIds):
+        """
+        Forget finished and deferred requests that TopCAT no longer lists
+        as RESTORING
+
+        Parameters:
+            preparedIds - the preparedIds from the latest TopCAT listing
+        """
+        keep = set(preparedIds)
+        with self.lock:
+            self.finished.intersection_update(keep)
+            for when, count, job in self.deferred:
+                if job.preparedId not in keep and self.jobs.get(job.preparedId) is job:
+                    del self.jobs[job.preparedId]
+
+
+    def size(self, unsized):
+        while True:
+            files, count, job = unsized.get()
+            try:
+                job.size = self.estimator(job)
+            except Exception:
+                self.logger.warn("Unable to estimate the size of request %s" % job.preparedId, exc_info=True)
+            self.queue.put(job)
+
+
+    def requeue(self):
+        """
+        Queue deferred jobs again once their delay is up
+        """
+        while True:
+            with self.later:
+                while not self.deferred or self.deferred[0][0] > time.time():
+                    self.later.wait(self.deferred[0][0] - time.time() if self.deferred else None)
+                when, count, job = heapq.heappop(self.deferred)
+                if self.jobs.get(job.preparedId) is not job:
+                    # dropped by retain()
+                    continue
+            self.queue.put(job)
+
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.state = COPYING
+            completed = deferred = False
+            try:
+                deferred = self.handler(job) is False
+                completed = not deferred
+            except Exception:
+                self.logger.error("Job for request %s failed" % job.preparedId, exc_info=True)
+            finally:
+                with self.lock:
+                    if deferred:
+                        job.state = READY
+                        self.count += 1
+                        heapq.heappush(self.deferred, (time.time() + self.deferDelay, self.count, job))
+                        self.later.notify()
+                    else:
+                        del self.jobs[job.preparedId]
+                        if completed:
+                            self.finished.add(job.preparedId)
+                self.queue.done(job)